@@ -1,8 +1,31 @@
 import os
 import logging
+import importlib
 
 logging.basicConfig(level=os.environ.get('PYTHON_LOGGING', 'ERROR'),
                     format='%(asctime)s %(levelname)-8s %(message)s',
                     datefmt='%Y-%m-%d %H:%M')
 
+# library API is imported on first use, so python -m atrtools.imgconv does not import the tool module twice
+_API = {
+    'convert_image': 'atrtools.imgconv',
+    'ImageOptions': 'atrtools.imgconv',
+    'convert_sap': 'atrtools.sapconv',
+    'SAPOptions': 'atrtools.sapconv',
+    'BankAllocator': 'atrtools.banks',
+    'allocate_banks': 'atrtools.banks',
+    'Pipeline': 'atrtools.pipeline',
+    'convert_batch': 'atrtools.pipeline',
+}
 
+__all__ = list(_API)
+
+
+def __getattr__(name):
+    if name in _API:
+        return getattr(importlib.import_module(_API[name]), name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
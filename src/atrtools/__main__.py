@@ -5,6 +5,8 @@ import logging
 
 from atrtools import imgconv
 from atrtools import sapconv
+from atrtools import banks
+from atrtools import pipeline
 
 VERSION = '0.2.0'
 
@@ -21,6 +23,16 @@ def run_imgconv(args):
     log().info('Running imgconv tool')
     imgconv.process(args)
 
+def run_banks(args):
+    "Run bank allocator with arguments"
+    log().info('Running banks tool')
+    banks.process(args)
+
+def run_batch(args):
+    "Run batch pipeline with arguments"
+    log().info('Running batch pipeline')
+    pipeline.process(args)
+
 def parse_args():
     "Parse command-line argumenmts"
     parent_parser = argparse.ArgumentParser(add_help=False)
@@ -34,12 +46,18 @@ def parse_args():
     
     parser_sapconv = subparsers.add_parser('sapconv', help='SAP music converter', parents=[parent_parser])
     parser_imgconv = subparsers.add_parser('imgconv', help='Gif image converter', parents=[parent_parser])
+    parser_banks = subparsers.add_parser('banks', help='Memory bank allocator', parents=[parent_parser])
+    parser_batch = subparsers.add_parser('batch', help='Batch converter', parents=[parent_parser])
     
     parser_sapconv.set_defaults(func=run_sapconv)
     parser_imgconv.set_defaults(func=run_imgconv)
+    parser_banks.set_defaults(func=run_banks)
+    parser_batch.set_defaults(func=run_batch)
 
     sapconv.add_parser_args(parser_sapconv)
     imgconv.add_parser_args(parser_imgconv)
+    banks.add_parser_args(parser_banks)
+    pipeline.add_parser_args(parser_batch)
 
     parsed_args = parser.parse_args()
     parsed_args.func(parsed_args)
@@ -0,0 +1,240 @@
+"""
+Memory bank allocator.
+Packs compressed blocks of converted assets into banks (XE extended memory or cartridge),
+blocks larger than bank are split at safe codec boundaries.
+"""
+
+import os
+import re
+import argparse
+import logging
+import collections
+
+from atrtools.compress import Compress
+from atrtools.imgconv import (convert_image, ImageOptions)
+from atrtools.sapconv import (convert_sap, SAPOptions)
+
+
+def log():
+    return logging.getLogger(__name__)
+
+
+Piece = collections.namedtuple('Piece', 'name part data')
+
+
+class Block:
+    "Data block to be placed in banks"
+
+    def __init__(self, name, data, boundaries=None, terminator=b''):
+        "Boundaries are offsets where data can be split, None allows any offset"
+        self.name = re.sub(r'\W', '_', name)
+        self.data = bytes(data)
+        self.boundaries = boundaries
+        self.terminator = terminator
+
+    def split_offset(self, limit):
+        "Return greatest offset where part (with terminator) fits into limit bytes, 0 if there is none"
+        limit -= len(self.terminator)
+        if self.boundaries is None:
+            return max(limit, 0)
+        return max((offset for offset in self.boundaries if offset <= limit), default=0)
+
+
+class Bank:
+    "Memory bank with placed pieces"
+
+    def __init__(self, number, size):
+        self.number = number
+        self.size = size
+        self.pieces = []
+
+    @property
+    def used(self):
+        return sum(len(piece.data) for piece in self.pieces)
+
+    @property
+    def free(self):
+        return self.size - self.used
+
+
+class BankAllocator:
+    "Allocate blocks to banks, first fit decreasing"
+
+    def __init__(self, bank_size=0x4000, base=0x4000):
+        self.bank_size = bank_size
+        self.base = base
+        self.blocks = []
+        self.banks = []
+
+    def add(self, name, data, boundaries=None, terminator=b''):
+        "Add block of data, block names (used as asm labels) must be unique"
+        block = Block(name, data, boundaries, terminator)
+        if any(other.name == block.name for other in self.blocks):
+            raise ValueError("Error: block {} maps to label {} used by another block!".format(name, block.name))
+        self.blocks.append(block)
+
+    def add_result(self, name, result):
+        "Add packed blocks of conversion result"
+        compressor = result.metadata.get('compressor')
+        if result.metadata.get('type') == 'R':
+            compressor_cls = Compress.create_compressor('stream')
+        else:
+            compressor_cls = Compress.create_compressor(compressor) if compressor else None
+        names = [block.get('name') for block in result.metadata.get('blocks', [])]
+        if len(names) != len(result.packed) or None in names:
+            # sap blocks and map strips are numbered, single image block keeps asset name
+            names = [name] if len(result.packed) == 1 and 'width' in result.metadata else \
+                    ['{}_{}'.format(name, idx) for idx in range(len(result.packed))]
+        blocks = zip(names, result.packed)
+        for block_name, data in blocks:
+            if compressor_cls:
+                self.add(block_name, data, compressor_cls.boundaries(data), compressor_cls.TERMINATOR)
+            else:
+                self.add(block_name, data)
+
+    def new_bank(self):
+        self.banks.append(Bank(len(self.banks), self.bank_size))
+        return self.banks[-1]
+
+    def allocate(self):
+        "Place blocks into banks and return list of banks"
+        self.banks = []
+        placed = []
+        for block in self.blocks:
+            part = 0
+            while len(block.data) > self.bank_size:
+                # oversized block fills fresh banks, parts stay in consecutive banks
+                offset = block.split_offset(self.bank_size)
+                if not offset and block.boundaries == []:
+                    raise ValueError("Error: block {} of {} bytes has no split points (incompressible data is "
+                                     "stored raw), it does not fit bank of {} bytes!".format(
+                                         block.name, len(block.data), self.bank_size))
+                if not offset:
+                    raise ValueError("Error: block {} cannot be split to fit bank of {} bytes!".format(
+                                     block.name, self.bank_size))
+                self.new_bank().pieces.append(Piece(block.name, part, block.data[:offset] + block.terminator))
+                boundaries = None if block.boundaries is None else \
+                             [value - offset for value in block.boundaries if value > offset]
+                block = Block(block.name, block.data[offset:], boundaries, block.terminator)
+                part += 1
+            placed.append(Piece(block.name, part, block.data))
+
+        for piece in sorted(placed, key=lambda piece: -len(piece.data)):
+            for bank in self.banks:
+                if bank.free >= len(piece.data):
+                    break
+            else:
+                bank = self.new_bank()
+            bank.pieces.append(piece)
+        log().info('Banks: %d Pieces: %d', len(self.banks), sum(len(bank.pieces) for bank in self.banks))
+        return self.banks
+
+    def pieces(self):
+        "Return (bank, address, piece) for all pieces in block and part order"
+        placed = []
+        for bank in self.banks:
+            address = self.base
+            for piece in bank.pieces:
+                placed.append((bank, address, piece))
+                address += len(piece.data)
+        order = {block.name: idx for idx, block in enumerate(self.blocks)}
+        return sorted(placed, key=lambda item: (order[item[2].name], item[2].part))
+
+    def table_lines(self, label):
+        "Generator for bank table asm lines, one entry per piece in load order"
+        pieces = self.pieces()
+        yield "\t.local banks_{} ; banks={} size={} base=${:04x}".format(label, len(self.banks), self.bank_size, self.base)
+        yield "count\t= {}".format(len(pieces))
+        for bank, address, piece in pieces:
+            yield "; {} part {} bank {} ${:04x} size={}".format(piece.name, piece.part, bank.number, address,
+                                                                  len(piece.data))
+        columns = (('bank', lambda bank, address, piece: bank.number),
+                   ('addr_lo', lambda bank, address, piece: address & 0xff),
+                   ('addr_hi', lambda bank, address, piece: address >> 8),
+                   ('size_lo', lambda bank, address, piece: len(piece.data) & 0xff),
+                   ('size_hi', lambda bank, address, piece: len(piece.data) >> 8))
+        for name, value in columns:
+            yield "{}\t.byte {}".format(name, ','.join('${:02x}'.format(value(*item)) for item in pieces))
+        yield "\t.endl"
+
+    def bank_lines(self, bank, number=20):
+        "Generator for asm lines of one bank"
+        yield "; bank {} used={} free={}".format(bank.number, bank.used, bank.free)
+        yield "\torg ${:04x}".format(self.base)
+        yield "\t.local bank_{}".format(bank.number)
+        for piece in bank.pieces:
+            yield "{}_{}\t; size={}".format(piece.name, piece.part, len(piece.data))
+            for idx in range(0, len(piece.data), number):
+                yield "\t\t.byte {}".format(",".join("${:02x}".format(i) for i in piece.data[idx:idx+number]))
+        yield "\t.endl"
+
+
+def allocate_banks(assets, bank_size=0x4000, base=0x4000):
+    "Allocate (name, result) pairs of converted assets to banks and return allocator"
+    allocator = BankAllocator(bank_size, base)
+    for name, result in assets:
+        allocator.add_result(name, result)
+    allocator.allocate()
+    return allocator
+
+
+def add_parser_args(parser):
+    "Add cli arguments to parser"
+    parser.add_argument('-s', '--sources', type=argparse.FileType('rb'), nargs='+',
+                        help='paths to source gif and sap files', required=True)
+    parser.add_argument('-d', '--destination', type=argparse.FileType('w'), help='path to destination asm file',
+                        required=True)
+    parser.add_argument('-S', '--bank-size', type=lambda value: int(value, 0), default=0x4000,
+                        help='bank size in bytes (default $4000)')
+    parser.add_argument('-A', '--bank-base', type=lambda value: int(value, 0), default=0x4000,
+                        help='bank window address (default $4000)')
+    parser.add_argument('-P', '--bank-prefix', help='save every bank to separate {prefix}{number}.asm file')
+    parser.add_argument('-l', '--label', default='1', help='bank table label name')
+    parser.add_argument('-c', '--compress', help='compress data', action='store_true')
+    parser.add_argument('-m', '--compressor', choices=('legacy', 'lz4', 'lz4-fast', 'hybrid', 'hybrid-lz4'), default='legacy', help='select compress type')
+    parser.add_argument('-e', '--verbose', action='store_true', help='generate more verbose output')
+
+def get_parser():
+    "Create parser and add cli arguments"
+    parser = argparse.ArgumentParser()
+    add_parser_args(parser)
+    return parser
+
+def process(args):
+    "Main processing"
+    log().debug("Start processing")
+    assets = []
+    for source in args.sources:
+        name = os.path.splitext(os.path.basename(source.name))[0]
+        if source.name.lower().endswith('.sap'):
+            result = convert_sap(source, SAPOptions(compress=args.compress, compressor=args.compressor))
+        else:
+            result = convert_image(source, ImageOptions(label=name, compress=args.compress,
+                                                        compressor=args.compressor))
+        assets.append((name, result))
+    allocator = allocate_banks(assets, args.bank_size, args.bank_base)
+    if args.verbose:
+        for bank in allocator.banks:
+            print("Bank {}: Used: {} Free: {} Pieces: {}".format(bank.number, bank.used, bank.free,
+                                                                  len(bank.pieces)))
+    for line in allocator.table_lines(args.label):
+        args.destination.write("{}\n".format(line))
+    for bank in allocator.banks:
+        if args.bank_prefix:
+            with open('{}{}.asm'.format(args.bank_prefix, bank.number), 'w') as destination:
+                for line in allocator.bank_lines(bank):
+                    destination.write("{}\n".format(line))
+        else:
+            args.destination.write("\n")
+            for line in allocator.bank_lines(bank):
+                args.destination.write("{}\n".format(line))
+    log().debug("Done")
+
+def main():
+    "Parse arguments and process data"
+    parser = get_parser()
+    args = parser.parse_args()
+    process(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+"""
+Character (tile) mode converter.
+Cuts packed image into 8x8 cells, deduplicates them and builds fonts with screen map.
+"""
+
+import logging
+
+from atrtools.imgconv import AtariImageConverter
+
+
+def log():
+    return logging.getLogger(__name__)
+
+
+class AtariCharsetConverter(AtariImageConverter):
+    "Atari character mode converter class"
+
+    GLYPHS = 128
+    CELL_HEIGHT = 8
+
+    def __init__(self, options, source):
+        super().__init__(options, source)
+        self.glyphs = []
+        self.fonts = []
+        self.screen = []
+        self.row_fonts = []
+        self.cells = 0
+        self.merged = 0
+        self.blocks = []
+
+    @property
+    def columns(self):
+        return int(self.bytes_per_line)
+
+    def process(self):
+        "Process image and build fonts with screen map"
+        super().process()
+        with self.stats.timer('tiles'):
+            cells = self.cut_cells()
+            self.glyphs, indices = self.deduplicate(cells)
+            if self.options.error_budget:
+                indices = self.merge_glyphs(indices)
+            self.build_fonts(indices)
+        log().info('Cells: %d Glyphs: %d Merged: %d Fonts: %d',
+                   self.cells, len(self.glyphs), self.merged, len(self.fonts))
+        if self.options.verbose:
+            print("Cells: {} Glyphs: {} Merged: {} Fonts: {}".format(
+                  self.cells, len(self.glyphs), self.merged, len(self.fonts)))
+
+    def cut_cells(self):
+        "Return list of character rows, each being list of 8-byte cells"
+        rows = list(self.rows)
+        height = self.__class__.CELL_HEIGHT
+        if len(rows) % height:
+            rows.extend(bytes(self.columns) for _ in range(height - len(rows) % height))
+        cells = [[bytes(column) for column in zip(*rows[i:i+height])] for i in range(0, len(rows), height)]
+        self.cells = sum(len(row) for row in cells)
+        return cells
+
+    @staticmethod
+    def deduplicate(cells):
+        "Return unique glyphs and character rows of glyph indices"
+        index = {}
+        indices = [[index.setdefault(cell, len(index)) for cell in row] for row in cells]
+        return list(index), indices
+
+    @staticmethod
+    def distance(first, second, bits, mask):
+        "Return number of differing pixels of two glyphs given as integers"
+        diff = first ^ second
+        for shift in range(1, bits):
+            diff |= diff >> shift
+        return bin(diff & mask).count('1')
+
+    def part_masks(self, bits):
+        """Return masks splitting glyph into error budget + 1 pixel ranges, glyphs within budget
+        have at least one range equal, single empty mask when budget covers all pixels"""
+        pixels = 8 * self.__class__.CELL_HEIGHT // bits
+        parts = self.options.error_budget + 1
+        if parts > pixels:
+            return [0]
+        bounds = [part * pixels // parts for part in range(parts + 1)]
+        return [((1 << (end - start) * bits) - 1) << start * bits for start, end in zip(bounds, bounds[1:])]
+
+    def merge_glyphs(self, indices):
+        """Merge glyphs differing by at most error budget pixels into nearest most used glyph,
+        only glyphs sharing some pixel range are compared"""
+        counts = [0]*len(self.glyphs)
+        for row in indices:
+            for glyph in row:
+                counts[glyph] += 1
+        values = [int.from_bytes(glyph, 'big') for glyph in self.glyphs]
+        bits = int(8/self.options.ratio)
+        mask = int.from_bytes(bytes([sum(1 << i for i in range(0, 8, bits))]*self.__class__.CELL_HEIGHT), 'big')
+        masks = self.part_masks(bits)
+        buckets = {}
+        kept = {}
+        mapping = {}
+        for glyph in sorted(range(len(self.glyphs)), key=lambda i: -counts[i]):
+            value = values[glyph]
+            candidates = set()
+            for part, part_mask in enumerate(masks):
+                candidates.update(buckets.get((part, value & part_mask), ()))
+            best = None
+            for other in candidates:
+                distance = self.distance(value, values[other], bits, mask)
+                if distance <= self.options.error_budget and \
+                   (best is None or (distance, kept[other]) < best[0]):
+                    best = ((distance, kept[other]), other)
+            if best:
+                mapping[glyph] = best[1]
+                continue
+            mapping[glyph] = glyph
+            kept[glyph] = len(kept)
+            for part, part_mask in enumerate(masks):
+                buckets.setdefault((part, value & part_mask), []).append(glyph)
+        self.merged = len(self.glyphs) - len(kept)
+        renumber = {glyph: number for number, glyph in enumerate(sorted(kept))}
+        self.glyphs = [self.glyphs[glyph] for glyph in sorted(kept)]
+        return [[renumber[mapping[glyph]] for glyph in row] for row in indices]
+
+    def build_fonts(self, indices):
+        "Allocate glyphs of character rows to fonts (first fit) and build screen map"
+        fonts = []
+        for row in indices:
+            needed = set(row)
+            assert len(needed) <= self.__class__.GLYPHS, \
+                "Error: character row uses more than {} glyphs, consider error budget!".format(self.__class__.GLYPHS)
+            for number, font in enumerate(fonts):
+                if len(needed.union(font)) <= self.__class__.GLYPHS:
+                    break
+            else:
+                fonts.append({})
+                number, font = len(fonts)-1, fonts[-1]
+            for glyph in row:
+                font.setdefault(glyph, len(font))
+            self.row_fonts.append(number)
+            self.screen.append(bytes(font[glyph] for glyph in row))
+        self.fonts = [b''.join(self.glyphs[glyph] for glyph in font) for font in fonts]
+
+    def compress(self):
+        "Compress fonts and screen map"
+        log().debug('Compressing fonts and screen map')
+        blocks = [('font_{}_{}'.format(self.options.label, number), font) for number, font in enumerate(self.fonts)]
+        blocks.append(('map_{}'.format(self.options.label), b''.join(self.screen)))
+        for name, data in blocks:
+            with self.stats.timer('compress'):
+                compressor = self.compressor_cls(data)
+                compressed = compressor.compress()
+            self.stats.count('compressed', len(compressed))
+            self.stats.add_compressor_stats(compressor.stats)
+            self.blocks.append((name, data, compressed))
+            if self.options.verbose:
+                print("{}: Size: {} Packed: {} Ratio: {:.2f}".format(name, len(data), len(compressed),
+                                                                     len(compressed) / len(data)))
+            log().info('%s: Size: %d Packed: %d', name, len(data), len(compressed))
+        self.compressed = b''.join(compressed for _, _, compressed in self.blocks)
+
+    def _save_asm(self):
+        "Save fonts and screen map as asm"
+        log().debug('Saving fonts and screen map to file')
+        for name, data, compressed in self.blocks:
+            if self.options.align and not self.options.compress and name.startswith('font_'):
+                self._write("\t.align $400")
+            if name.startswith('font_'):
+                self._write("\t.local {} ; glyphs={}".format(name, len(data)//self.__class__.CELL_HEIGHT))
+                number = self.__class__.CELL_HEIGHT
+            else:
+                self._write("\t.local {} ; columns={} rows={}".format(name, self.columns, len(self.screen)))
+                number = self.columns
+            generated_lines = self.generate_data_lines(data, number) if not self.options.compress else \
+                              self.generate_data_lines(compressed, self.options.number)
+            for line in generated_lines:
+                self._write(line)
+            self._write("\t.endl")
+
+        self._write("\t.local font_rows_{} ; font number per character row".format(self.options.label))
+        for line in self.generate_data_lines(self.row_fonts, self.options.number):
+            self._write(line)
+        self._write("\t.endl")
+        self.write_colors()
+        self.write_uncompress()
+
+    def _save_bin(self):
+        "Save fonts followed by screen map"
+        for _, data, compressed in self.blocks:
+            self.output.append(compressed if self.options.compress else data)
+        log().debug('Saved fonts and screen map')
+
+    def packed_blocks(self):
+        "Return fonts and screen map"
+        return [bytes(compressed if self.options.compress else data) for _, data, compressed in self.blocks]
+
+    def result(self):
+        "Return conversion result"
+        result = super().result()
+        result.metadata.update({
+            'columns': self.columns,
+            'rows': len(self.screen),
+            'cells': self.cells,
+            'glyphs': len(self.glyphs),
+            'merged': self.merged,
+            'row_fonts': list(self.row_fonts),
+            'blocks': [{'name': name, 'size': len(data), 'packed': len(compressed)}
+                       for name, data, compressed in self.blocks],
+        })
+        return result
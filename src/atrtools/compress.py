@@ -1,36 +1,73 @@
 "Simple compression routine."
 
 import logging
+import collections
 import lz4.frame
 
-from atrtools.uncompress import (UncompressLegacy, UncompressLz4)
+from atrtools.uncompress import (UncompressLegacy, UncompressLz4, UncompressStream,
+                                  UncompressHybridLegacy, UncompressHybridLz4, UncompressLz4Fast)
 
 
 def log():
     return logging.getLogger(__name__)
 
 
+Sequence = collections.namedtuple('Sequence', 'start literal end literals offset match')
+InPlace = collections.namedtuple('InPlace', 'offset margin')
+Chunk = collections.namedtuple('Chunk', 'stored data packed backend')
+
+
 class Compress:
     "Generic compress class"
 
+    TERMINATOR = b''
+
     def __init__(self, data):
         "Construct object from byte data."
         self.data = data
         self.len = len(data)
-        
+        self.stats = {'runs': 0, 'literals': 0, 'matches': 0}
+
     def compress(self):
         "Generic compress class"
         raise NotImplementedError('This method is not implemented')
 
+    def inplace(self, compressed):
+        "Return in-place decoding layout of compressed data"
+        raise NotImplementedError('This method is not implemented')
+
+    def layout(self, compressed, offset):
+        """Return in-place layout for minimal offset of compressed data in destination buffer.
+        Packed data is placed at the buffer end when possible, otherwise it sticks out by margin bytes."""
+        offset = max(offset, self.len - len(compressed), 0)
+        return InPlace(offset, offset + len(compressed) - self.len)
+
+    @classmethod
+    def boundaries(cls, compressed):
+        """Return offsets where compressed data can be split into separately decoded parts.
+        Every part but the last one has to be followed by TERMINATOR."""
+        raise NotImplementedError('This method is not implemented')
+
     @classmethod
     def create_compressor(cls, name):
-        return {'legacy': LegacyCompress, 'lz4': Lz4Compress}[name]
+        return {'legacy': LegacyCompress, 'lz4': Lz4Compress, 'lz4-fast': Lz4Compress.preset('speed'),
+                'stream': StreamCompress,
+                'hybrid': HybridLegacyCompress, 'hybrid-lz4': HybridLz4Compress}[name]
 
 
 class Lz4Compress(Compress):
-    
+    "Lz4 compress class, size preset: default compression level and compact decoder"
+
     LZ4_SKIP_FIRST = 11
     LZ4_SKIP_LAST = 0
+    TERMINATOR = b'\x00\x00\x00'
+    PRESET = 'size'
+    COMPRESSION_LEVEL = 0
+
+    @classmethod
+    def preset(cls, name):
+        "Return lz4 compress class for size or speed preset"
+        return {'size': Lz4Compress, 'speed': Lz4FastCompress}[name]
 
     def compress(self):
         "Compress using lz4 algorithm"
@@ -41,19 +78,115 @@ class Lz4Compress(Compress):
         # else:
         #     input_data = data[:4080] + bytearray(0 for i in range(16)) + data[4080:]
         compressed = lz4.frame.compress(self.data, block_linked=False, 
-                                        return_bytearray=True, store_size=False)
+                                        return_bytearray=True, store_size=False,
+                                        compression_level=self.__class__.COMPRESSION_LEVEL)
+        skip = self.__class__.LZ4_SKIP_FIRST
+        self.stored = skip >= 4 and bool(compressed[skip-1] & 0x80)
+        if self.stored:
+            log().warning('Lz4 block stored uncompressed, data is not compressible')
         if self.__class__.LZ4_SKIP_FIRST:
             compressed = compressed[self.__class__.LZ4_SKIP_FIRST:]
         if self.__class__.LZ4_SKIP_LAST:
             compressed = compressed[:-self.__class__.LZ4_SKIP_LAST]
+        for sequence in self.sequences(compressed) if not self.stored else ():
+            self.stats['literals'] += sequence.literals
+            if sequence.match:
+                self.stats['matches'] += 1
+                if sequence.offset == 1:
+                    self.stats['runs'] += 1
         return compressed
 
+    @staticmethod
+    def sequences(compressed):
+        "Parse compressed block and yield its sequences"
+        def length(idx, value):
+            "Read extended length"
+            if value == 15:
+                while True:
+                    byte = compressed[idx]
+                    idx += 1
+                    value += byte
+                    if byte != 255:
+                        break
+            return idx, value
+
+        idx = 0
+        while idx < len(compressed):
+            start = idx
+            token = compressed[idx]
+            idx, literals = length(idx+1, token >> 4)
+            literal = idx
+            idx += literals
+            offset = compressed[idx] | compressed[idx+1] << 8 if idx+1 < len(compressed) else 0
+            idx += 2
+            if not offset:
+                yield Sequence(start, literal, min(idx, len(compressed)), literals, 0, 0)
+                break
+            idx, match = length(idx, token & 15)
+            yield Sequence(start, literal, idx, literals, offset, match+4)
+
+    @classmethod
+    def boundaries(cls, compressed):
+        "Sequence ends followed by another sequence, decoder keeps destination between parts"
+        offsets = []
+        out = 0
+        try:
+            for sequence in cls.sequences(compressed):
+                out += sequence.literals
+                if sequence.offset > out:
+                    # match before data start, raw bytes of stored block
+                    return []
+                out += sequence.match
+                offsets.append(sequence.end if sequence.match else None)
+        except IndexError:
+            return []
+        if not offsets or offsets[-1] is not None or None in offsets[:-1] or \
+           compressed[sequence.literal+sequence.literals:] != bytes(4 - cls.LZ4_SKIP_LAST):
+            # stored or truncated block, last literals must be followed by frame end mark
+            return []
+        return offsets[:-1]
+
+    def inplace(self, compressed):
+        "Return in-place layout"
+        return self.layout(compressed, self.min_offset(compressed))
+
+    def min_offset(self, compressed):
+        """Simulate decoding and return minimal offset of compressed data in destination.
+        Every output byte must be written below packed bytes still to be read."""
+        if self.stored:
+            return self.len
+        offset = 0
+        out = 0
+        for sequence in self.sequences(compressed):
+            if sequence.literals:
+                # literal is read just before it is stored
+                offset = max(offset, out - sequence.literal)
+            out += sequence.literals
+            if sequence.match:
+                # offset and length bytes are read before match is copied
+                out += sequence.match
+                offset = max(offset, out - sequence.end)
+        return offset
+
     @classmethod
     def uncompress(cls):
         "Return 6502 uncompress routine"
         return UncompressLz4()
 
 
+class Lz4FastCompress(Lz4Compress):
+    """Lz4 compress class, speed preset: high compression level gives fewer and longer sequences,
+    decoder copies them page-wise"""
+
+    PRESET = 'speed'
+    COMPRESSION_LEVEL = lz4.frame.COMPRESSIONLEVEL_MINHC
+
+    @classmethod
+    def uncompress(cls):
+        "Return speed optimized 6502 uncompress routine"
+        return UncompressLz4Fast()
+
+
 class LegacyCompress(Compress):
     "Legacy compress class"
 
@@ -94,14 +227,205 @@ class LegacyCompress(Compress):
         compressed = self.__pack()
         for data in compressed:
             data.export(packed)
+            if isinstance(data, RepeatedValues):
+                self.stats['runs'] += 1
+            else:
+                self.stats['literals'] += len(data.values)
         return bytearray(packed)
 
+    def inplace(self, compressed):
+        "Return in-place layout"
+        return self.layout(compressed, self.min_offset(compressed))
+
+    def min_offset(self, compressed):
+        """Simulate decoding and return minimal offset of compressed data in destination.
+        Every output byte must be written below packed bytes still to be read."""
+        offset = 0
+        out = 0
+        idx = 0
+        while idx < len(compressed):
+            cmd = compressed[idx]
+            if cmd < 0b11000000:
+                # zero or value run, command (and value) is read before run is written
+                idx += 1 if cmd < 0b10000000 else 2
+                out += (cmd & 0b00111111 or 64) if cmd >= 0b10000000 else (cmd or 128)
+                offset = max(offset, out - idx)
+            else:
+                # unique values, each one is read just before it is written
+                count = cmd & 0b00111111 or 64
+                offset = max(offset, out - idx - 1)
+                idx += count + 1
+                out += count
+        return offset
+
+    @classmethod
+    def boundaries(cls, compressed):
+        "Command starts, decoder keeps destination between parts"
+        offsets = []
+        idx = 0
+        while idx < len(compressed):
+            if idx:
+                offsets.append(idx)
+            cmd = compressed[idx]
+            if cmd < 0b10000000:
+                idx += 1
+            elif cmd < 0b11000000:
+                idx += 2
+            else:
+                idx += (cmd & 0b00111111 or 64) + 1
+        return offsets
+
     @classmethod
     def uncompress(cls):
         "Return 6502 uncompress routine"
         return UncompressLegacy()
 
 
+class StreamCompress(Compress):
+    """Frame streaming compress class, decoder fetches one value per frame.
+    Command 0nnnnnnn repeats following value n+1 times, 1nnnnnnn is followed by n+1 literal values."""
+
+    MAX_COUNT = 128
+    MIN_RUN = 3
+
+    def compress(self):
+        "Compress and export data to bytearray"
+        log().debug('Stream compression')
+        packed = bytearray()
+        literals = bytearray()
+
+        def flush():
+            for idx in range(0, len(literals), self.__class__.MAX_COUNT):
+                chunk = literals[idx:idx+self.__class__.MAX_COUNT]
+                packed.append(0b10000000 | len(chunk)-1)
+                packed.extend(chunk)
+                self.stats['literals'] += len(chunk)
+            literals.clear()
+
+        idx = 0
+        while idx < self.len:
+            value = self.data[idx]
+            run = 1
+            while idx+run < self.len and run < self.__class__.MAX_COUNT and self.data[idx+run] == value:
+                run += 1
+            if run >= self.__class__.MIN_RUN:
+                flush()
+                packed.extend((run-1, value))
+                self.stats['runs'] += 1
+            else:
+                literals.extend(self.data[idx:idx+run])
+            idx += run
+        flush()
+        return packed
+
+    def inplace(self, compressed):
+        "Streams are decoded into registers, not into buffer"
+        raise NotImplementedError('Stream data is not decoded in-place')
+
+    @classmethod
+    def boundaries(cls, compressed):
+        "Player reads streams continuously, they cannot be split"
+        return []
+
+    @classmethod
+    def uncompress(cls):
+        "Return 6502 frame streaming player routine"
+        return UncompressStream()
+
+
+class HybridCompress(Compress):
+    """Chunked compress class, every chunk is compressed by backend or stored when packing does not pay off.
+    Every chunk is preceded by word with packed size (bit 15 set for stored chunk), zero word ends data.
+    Packed size never exceeds data size plus 2 bytes per chunk and terminator."""
+
+    TERMINATOR = b'\x00\x00'
+    BACKEND = None
+    CHUNK_SIZE = 1024
+    MAX_CHUNK = 0x7fff
+    STORED = 0x8000
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.stats['stored'] = 0
+        self.chunks = []
+
+    def compress(self):
+        "Compress chunks, consecutive stored chunks are merged"
+        log().debug('Hybrid compression, chunk size %d', self.__class__.CHUNK_SIZE)
+        self.chunks = []
+        for idx in range(0, self.len, self.__class__.CHUNK_SIZE):
+            data = self.data[idx:idx+self.__class__.CHUNK_SIZE]
+            backend = self.__class__.BACKEND(data)
+            packed = backend.compress()
+            if len(packed) < len(data) and not getattr(backend, 'stored', False):
+                for name, value in backend.stats.items():
+                    self.stats[name] += value
+                self.chunks.append(Chunk(False, data, packed, backend))
+            elif self.chunks and self.chunks[-1].stored and \
+                 len(self.chunks[-1].data) + len(data) <= self.__class__.MAX_CHUNK:
+                merged = self.chunks[-1].data + data
+                self.chunks[-1] = Chunk(True, merged, merged, None)
+            else:
+                self.chunks.append(Chunk(True, data, data, None))
+        self.stats['stored'] += sum(len(chunk.data) for chunk in self.chunks if chunk.stored)
+        packed = bytearray()
+        for chunk in self.chunks:
+            packed.extend((len(chunk.packed) | (self.__class__.STORED if chunk.stored else 0)).to_bytes(2, 'little'))
+            packed.extend(chunk.packed)
+        return packed + self.__class__.TERMINATOR
+
+    def inplace(self, compressed):
+        """Return in-place layout, size word is read just before its chunk is decoded.
+        Compressed chunks use backend layout, stored chunks are copied forward."""
+        offset = 0
+        out = 0
+        position = 0
+        for chunk in self.chunks:
+            offset = max(offset, out - position)
+            position += 2
+            if chunk.stored:
+                offset = max(offset, out - position)
+            else:
+                offset = max(offset, out - position + chunk.backend.min_offset(chunk.packed))
+            out += len(chunk.data)
+            position += len(chunk.packed)
+        offset = max(offset, out - position)
+        return self.layout(compressed, offset)
+
+    @classmethod
+    def boundaries(cls, compressed):
+        "Chunk starts, decoder keeps destination between parts"
+        offsets = []
+        idx = 0
+        while idx < len(compressed) - 2:
+            if idx:
+                offsets.append(idx)
+            idx += 2 + (int.from_bytes(compressed[idx:idx+2], 'little') & ~cls.STORED)
+        return offsets
+
+
+class HybridLegacyCompress(HybridCompress):
+    "Hybrid compress class with legacy backend"
+
+    BACKEND = LegacyCompress
+
+    @classmethod
+    def uncompress(cls):
+        "Return 6502 chunk table and legacy uncompress routines"
+        return UncompressHybridLegacy()
+
+
+class HybridLz4Compress(HybridCompress):
+    "Hybrid compress class with lz4 backend"
+
+    BACKEND = Lz4Compress
+
+    @classmethod
+    def uncompress(cls):
+        "Return 6502 chunk table and lz4 uncompress routines"
+        return UncompressHybridLz4()
+
+
 class RepeatedValues:
     "Type for single value repeated."
 
@@ -0,0 +1,75 @@
+"""
+Bitmap converter storing every unique scanline once.
+Display list points repeated lines to shared data with LMS instructions.
+"""
+
+import logging
+
+from atrtools.imgconv import AtariImageConverter
+from atrtools.dlist import DisplayList
+
+
+def log():
+    return logging.getLogger(__name__)
+
+
+class AtariDedupConverter(AtariImageConverter):
+    "Atari bitmap converter with duplicate scanlines eliminated"
+
+    def __init__(self, options, source):
+        super().__init__(options, source)
+        self.offsets = []
+
+    def pack(self, img):
+        "Pack image rows, store unique rows only"
+        self.rows = self.pack_rows(img)
+        self.lines, self.offsets = self.store_lines(self.rows)
+        size = sum(len(line) for line in self.lines)
+        self.stats.count('packed', size)
+        saved = sum(len(row) for row in self.rows) - size
+        log().info('Lines: %d Unique: %d Saved: %d', len(self.rows), len(self.lines), saved)
+        if self.options.verbose:
+            print("Lines: {} Unique: {} Saved: {}".format(len(self.rows), len(self.lines), saved))
+
+    @staticmethod
+    def store_lines(rows):
+        """Return unique lines and data offset of every row.
+        Line which would cross 4K boundary is moved to the boundary."""
+        index = {}
+        lines = []
+        offsets = []
+        size = 0
+        for row in rows:
+            if row not in index:
+                pad = DisplayList.place(size, len(row)) - size
+                lines.append([0]*pad + list(row))
+                index[row] = size + pad
+                size += pad + len(row)
+            offsets.append(index[row])
+        return lines, offsets
+
+    def build_dlist(self):
+        "Build display list, LMS is set for every line not following previous one in memory"
+        dlist = DisplayList(self.options.label)
+        dlist.blank()
+        interrupts = self.dlist_interrupts()
+        following = None
+        for vpos, (row, offset) in enumerate(zip(self.rows, self.offsets)):
+            address = None
+            if offset != following:
+                address = 'image_{}'.format(self.options.label) if not offset else \
+                          'image_{}+${:x}'.format(self.options.label, offset)
+            dlist.mode_line(self.options.antic_mode, address, vpos in interrupts)
+            following = offset + len(row)
+        dlist.check_size()
+        return dlist
+
+    def result(self):
+        "Return conversion result"
+        result = super().result()
+        result.metadata.update({
+            'lines': len(self.rows),
+            'unique': len(self.lines),
+            'offsets': list(self.offsets),
+        })
+        return result
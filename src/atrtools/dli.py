@@ -0,0 +1,172 @@
+"""
+Bitmap converter with per-band palettes.
+Colors are switched between scanline bands by display list interrupt handler.
+"""
+
+import logging
+
+from PIL import Image
+
+from atrtools.imgconv import AtariImageConverter
+
+
+def log():
+    return logging.getLogger(__name__)
+
+
+class AtariDLIConverter(AtariImageConverter):
+    "Atari bitmap converter with display list interrupt palettes"
+
+    REGISTERS = {4: ('COLBK', 'COLPF0', 'COLPF1', 'COLPF2'),
+                 8: ('COLPF2', 'COLPF1')}
+    HARDWARE = {'COLPF0': '$D016', 'COLPF1': '$D017', 'COLPF2': '$D018', 'COLBK': '$D01A', 'WSYNC': '$D40A'}
+    SHADOW = {'COLPF0': '$02C4', 'COLPF1': '$02C5', 'COLPF2': '$02C6', 'COLBK': '$02C8'}
+
+    def __init__(self, options, source):
+        super().__init__(options, source)
+        self.bands = []
+
+    @property
+    def registers(self):
+        assert self.options.ratio in self.__class__.REGISTERS, \
+            "Error: dli mode supports ratio {} only!".format(' and '.join(map(str, self.__class__.REGISTERS)))
+        return self.__class__.REGISTERS[self.options.ratio]
+
+    def pack(self, img):
+        "Split image into bands, remap colors to band palette slots and pack"
+        pixels = img.tobytes()
+        with self.stats.timer('bands'):
+            self.bands = self.assign_slots(self.find_bands(pixels, img.width, img.height))
+        ends = [start for start, _ in self.bands[1:]] + [img.height]
+        remapped = bytearray()
+        for (start, palette), end in zip(self.bands, ends):
+            table = bytearray(256)
+            for slot, color in enumerate(palette):
+                table[color] = slot
+            remapped.extend(pixels[start*img.width: end*img.width].translate(table))
+        super().pack(Image.frombytes('L', img.size, bytes(remapped)))
+        log().info('Bands: %d Register writes: %d', len(self.bands), self.register_writes())
+        if self.options.verbose:
+            print("Bands: {} Register writes: {}".format(len(self.bands), self.register_writes()))
+
+    def find_bands(self, pixels, width, height):
+        "Return minimal list of bands (start row, color set) fitting into color registers"
+        slots = len(self.registers)
+        bands = []
+        start = 0
+        current = set()
+        for vpos in range(0, height):
+            colors = set(pixels[vpos*width: (vpos+1)*width])
+            assert len(colors) <= slots, "Error: row {} uses more than {} colors!".format(vpos, slots)
+            if len(current | colors) > slots:
+                bands.append((start, current))
+                start, current = vpos, colors
+            else:
+                current |= colors
+        bands.append((start, current))
+        return bands
+
+    def assign_slots(self, bands):
+        "Assign band colors to register slots, keeping slots of colors shared with previous band"
+        previous = [0]*len(self.registers)
+        result = []
+        for start, colors in bands:
+            palette = [color if color in colors and result else None for color in previous]
+            remaining = sorted(colors.difference(palette))
+            palette = [remaining.pop(0) if color is None and remaining else color for color in palette]
+            palette = [previous[slot] if color is None else color for slot, color in enumerate(palette)]
+            result.append((start, tuple(palette)))
+            previous = palette
+        return result
+
+    def changing_slots(self):
+        "Return register slots whose color changes at some band boundary"
+        return [slot for slot in range(len(self.registers))
+                if any(previous[slot] != palette[slot] for (_, previous), (_, palette) in zip(self.bands, self.bands[1:]))]
+
+    def register_writes(self):
+        "Return number of color register writes done by interrupt handler, changing registers are written every band"
+        return len(self.changing_slots()) * (len(self.bands) - 1)
+
+    def atari_color(self, color):
+        "Return Atari color of palette index"
+        return self.atari_colors[color][3] if color < len(self.atari_colors) else 0
+
+    def dlist_interrupts(self):
+        "Interrupt is requested on the last line of each band"
+        return set(start-1 for start, _ in self.bands[1:])
+
+    def write_colors(self):
+        "Append first band colors and display list interrupt handler"
+        log().debug('Saving band palettes')
+        self._write("\t.local colors_{}".format(self.options.label))
+        for slot, color in enumerate(self.bands[0][1]):
+            self._write("c{}\t\t.byte ${:02x} ; {}".format(slot, self.atari_color(color), self.registers[slot]))
+        self._write("\t.endl")
+        if len(self.bands) > 1:
+            self.write_dli()
+
+    def write_dli(self):
+        "Append display list interrupt handler and color tables of registers changing between bands"
+        log().debug('Saving display list interrupt handler')
+        registers = self.registers
+        changing = [registers[slot] for slot in self.changing_slots()]
+        self._write("\t.local dli_{} ; bands={} register writes={}".format(
+                    self.options.label, len(self.bands), self.register_writes()))
+        for name in ('WSYNC',) + registers:
+            self._write("{} = {}".format(name, self.__class__.HARDWARE[name]))
+        self._write_text("""; call reset in vbi, set vdslst to handler and enable dli
+handler\tpha
+\t\ttxa
+\t\tpha
+\t\ttya
+\t\tpha
+\t\tldx #$01
+band\tequ *-1""")
+        # first two colors are loaded before WSYNC and stored right at the start of line
+        self._write("\t\tlda tab_{},x".format(changing[0].lower()))
+        if len(changing) > 1:
+            self._write("\t\tldy tab_{},x".format(changing[1].lower()))
+        self._write("\t\tsta WSYNC")
+        self._write("\t\tsta {}".format(changing[0]))
+        if len(changing) > 1:
+            self._write("\t\tsty {}".format(changing[1]))
+        for name in changing[2:]:
+            self._write("\t\tlda tab_{},x".format(name.lower()))
+            self._write("\t\tsta {}".format(name))
+        self._write_text("""\t\tinc band
+\t\tpla
+\t\ttay
+\t\tpla
+\t\ttax
+\t\tpla
+\t\trti""")
+        self._write("reset")
+        for slot, name in enumerate(registers):
+            if name in changing:
+                self._write("\t\tlda tab_{}".format(name.lower()))
+            else:
+                self._write("\t\tlda #${:02x}".format(self.atari_color(self.bands[0][1][slot])))
+            self._write("\t\tsta {}".format(self.__class__.SHADOW[name]))
+        self._write_text("""\t\tlda #$01
+\t\tsta band
+\t\trts""")
+        self._write("lines\t; first line of every band")
+        for line in self.generate_data_lines([start for start, _ in self.bands], self.options.number):
+            self._write(line)
+        for slot in self.changing_slots():
+            self._write("tab_{}".format(registers[slot].lower()))
+            for line in self.generate_data_lines([self.atari_color(palette[slot]) for _, palette in self.bands],
+                                                 self.options.number):
+                self._write(line)
+        self._write("\t.endl")
+
+    def result(self):
+        "Return conversion result"
+        result = super().result()
+        result.metadata.update({
+            'bands': [start for start, _ in self.bands],
+            'palettes': [[self.atari_color(color) for color in palette] for _, palette in self.bands],
+            'register_writes': self.register_writes(),
+        })
+        return result
@@ -0,0 +1,88 @@
+"""
+ANTIC display list builder.
+Collects display list instructions and exports them as MADS asm lines.
+"""
+
+import logging
+
+
+def log():
+    return logging.getLogger(__name__)
+
+
+class DisplayList:
+    "Display list builder class"
+
+    BLANK_8 = 0x70
+    JVB = 0x41
+    LMS = 0x40
+    DLI = 0x80
+    HSCROL = 0x10
+    VSCROL = 0x20
+    BOUNDARY = 4096
+    LIMIT = 1024
+
+    def __init__(self, label):
+        self.label = label
+        self.instructions = []
+
+    @classmethod
+    def place(cls, offset, length):
+        "Return offset of screen line placed at or after offset, ANTIC line cannot cross 4K boundary"
+        if length > cls.BOUNDARY:
+            raise ValueError("Error: screen line of {} bytes exceeds 4K!".format(length))
+        if offset // cls.BOUNDARY != (offset + length - 1) // cls.BOUNDARY:
+            offset += -offset % cls.BOUNDARY
+        return offset
+
+    def check_size(self):
+        "Raise error when display list does not fit into 1K, it cannot cross 1K boundary"
+        if self.size() > self.__class__.LIMIT:
+            raise ValueError("Error: display list of {} bytes crosses 1K boundary!".format(self.size()))
+
+    def blank(self, count=3):
+        "Append blank 8-line instructions"
+        self.instructions.extend((self.__class__.BLANK_8, None) for _ in range(count))
+
+    def mode_line(self, mode, address=None, dli=False, hscroll=False, vscroll=False):
+        "Append mode line, with LMS when address is given"
+        opcode = mode | (self.__class__.LMS if address else 0) | (self.__class__.DLI if dli else 0) | \
+                 (self.__class__.HSCROL if hscroll else 0) | (self.__class__.VSCROL if vscroll else 0)
+        self.instructions.append((opcode, address))
+
+    def size(self):
+        "Return display list size in bytes"
+        return sum(3 if address else 1 for _, address in self.instructions) + 3
+
+    def address_offsets(self):
+        "Return display list offsets of LMS address operands"
+        offsets = []
+        offset = 0
+        for _, address in self.instructions:
+            if address:
+                offsets.append(offset + 1)
+            offset += 3 if address else 1
+        return offsets
+
+    def generate_lines(self):
+        "Generator for asm lines, repeated instructions are merged"
+        def line(count, opcode, address):
+            prefix = ':{}'.format(count) if count > 1 else ''
+            tabs = '\t\t' if len(prefix) < 4 else '\t'
+            operands = '${:02x}, a({})'.format(opcode, address) if address else '${:02x}'.format(opcode)
+            return '{}{}.byte {}'.format(prefix, tabs, operands)
+
+        yield "\t.local dlist_{}".format(self.label)
+        count = 0
+        previous = None
+        for instruction in self.instructions:
+            if instruction == previous and not instruction[1]:
+                count += 1
+                continue
+            if previous:
+                yield line(count, *previous)
+            previous, count = instruction, 1
+        if previous:
+            yield line(count, *previous)
+        yield line(1, self.__class__.JVB, 'dlist_{}'.format(self.label))
+        yield "\t.endl"
@@ -3,6 +3,7 @@ This is converter of indexed gif files (1-8 colors) to Atari .asm data file.
 Requires pillow package to be installed.
 """
 
+import io
 import os
 import argparse
 import logging
@@ -12,12 +13,18 @@ import itertools
 from PIL import Image
 
 from atrtools.compress import (LegacyCompress, Lz4Compress, Compress)
+from atrtools.stats import (Stats, run_converter, profile)
+from atrtools.options import (Options, Result)
+from atrtools.dlist import DisplayList
 
 def log():
 	return logging.getLogger(__name__)
 
 class RGB2AtariColorConverter:
     "Convert RGB value to ATARI HUE/SAT"
+
+    PALETTE = None
+    CACHE = {}
     
     def __init__(self, hex_val):
         self.colors = (int(hex_val[0:2], 16), int(hex_val[2:4], 16), int(hex_val[4:6], 16))
@@ -26,13 +33,16 @@ class RGB2AtariColorConverter:
         self.colintens = 80
         self.colshift = 40
         self.calc = [0 for i in range(0,256)]
-        self.rgb = [[0 for i in range(0,3)] for j in range(0,256)]
-        self.value = self.convert()
-
-    def convert(self):
-        "Convert colors"
-        ir, ig, ib = self.colors
-        m = 0xFFFFF
+        self.rgb = self.palette()
+        if self.colors not in self.__class__.CACHE:
+            self.__class__.CACHE[self.colors] = self.convert()
+        self.value = self.__class__.CACHE[self.colors]
+
+    def palette(self):
+        "Return Atari palette rgb values, calculated once"
+        if self.__class__.PALETTE:
+            return self.__class__.PALETTE
+        rgb = [[0 for i in range(0,3)] for j in range(0,256)]
         clip_var = lambda x: 0xff if x>0xff else (0 if x <0 else x)
 
         for i in range(0, 16):
@@ -52,9 +62,17 @@ class RGB2AtariColorConverter:
                 g1 = clip_var(g1)
                 b1 = clip_var(b1)
 
-                self.rgb[i * 16 + j][0] = r1
-                self.rgb[i * 16 + j][1] = g1
-                self.rgb[i * 16 + j][2] = b1
+                rgb[i * 16 + j][0] = r1
+                rgb[i * 16 + j][1] = g1
+                rgb[i * 16 + j][2] = b1
+
+        self.__class__.PALETTE = rgb
+        return rgb
+
+    def convert(self):
+        "Convert colors"
+        ir, ig, ib = self.colors
+        m = 0xFFFFF
 
         for i in range(0, 256):
             r2 = ir - self.rgb[i][0]
@@ -75,25 +93,93 @@ class RGB2AtariColorConverter:
         return val
 
 
+class ImageOptions(Options):
+    "Image conversion options"
+    DEFAULTS = {
+        'number': 20,
+        'label': '1',
+        'display_list': False,
+        'ratio': 4,
+        'type': 'asm',
+        'verbose': False,
+        'compressor': 'legacy',
+        'compress': False,
+        'antic_mode': 14,
+        'align': False,
+        'mode': 'bitmap',
+        'error_budget': 0,
+        'frame_width': 8,
+        'frame_height': 0,
+        'inplace': False,
+        'strip': 'rows',
+        'strip_size': 8,
+        'window': 0,
+    }
+
+
 class AtariImageConverter:
     "Atari image converter class"
 
-    def __init__(self, args):
-        self.args = args
+    def __init__(self, options, source):
+        "Construct converter from options and gif source (bytes, file object or PIL image)"
+        self.options = options
+        self.source = source
+        self.rows = []
         self.lines = []
         self.width = None
         self.height = None
         self.compressed = None
-        self.compressor_cls = Compress.create_compressor(self.args.compressor)
+        self.layout = None
+        self.compressor_cls = Compress.create_compressor(self.options.compressor)
         self.colors = []
+        self.atari_colors = []
+        self.output = []
+        self.uncompress = None
+        self.stats = Stats('imgconv')
+
+    @classmethod
+    def create_converter(cls, mode):
+        "Return converter class for given conversion mode"
+        from atrtools.charset import AtariCharsetConverter
+        from atrtools.pmg import AtariPMGConverter
+        from atrtools.dli import AtariDLIConverter
+        from atrtools.dedup import AtariDedupConverter
+        from atrtools.scrollmap import AtariMapConverter
+        return {'bitmap': AtariImageConverter,
+                'charset': AtariCharsetConverter,
+                'pmg': AtariPMGConverter,
+                'dli': AtariDLIConverter,
+                'dedup': AtariDedupConverter,
+                'map': AtariMapConverter}[mode]
 
     @property
     def bytes_per_line(self):
-        return self.width / self.args.ratio
+        return self.width / self.options.ratio
         
     def process(self):
         "Process image"
         log().debug('Processing image data')
+        with self.stats.timer('load'):
+            img = self.load()
+        logging.debug("Image resolution: %dx%d", img.width, img.height)
+
+        if self.options.verbose:
+            print("Image resolution: {}x{}".format(img.width, img.height))
+        
+        self.width, self.height = (img.width, img.height)
+        with self.stats.timer('pack'):
+            self.pack(img)
+        with self.stats.timer('quantize'):
+            self.quantize(img)
+
+    def pack(self, img):
+        "Pack image into rows and padded lines"
+        self.rows = self.pack_rows(img)
+        self.lines = self.pad_lines(self.rows)
+        self.stats.count('packed', sum(len(row) for row in self.rows))
+
+    def quantize(self, img):
+        "Convert image palette to Atari colors"
         def color_generator():
             buffer = []
             for c in img.palette.palette:
@@ -102,35 +188,52 @@ class AtariImageConverter:
                     yield "{:02x}{:02x}{:02x}".format(*buffer)
                     buffer = []
 
-        lines = []
-        img = Image.open(self.args.source)
-        logging.debug("Image resolution: %dx%d", img.width, img.height)
-
-        if self.args.verbose:
-            print("Image resolution: {}x{}".format(img.width, img.height))
-        
-        self.width, self.height = (img.width, img.height)
-        no_bytes = 0
-        for vpos in range(0, img.height):
-            line = []
-            for hbyte in range(0, int(img.width/self.args.ratio)):
-                bval = 0
-                for i in range(0, self.args.ratio):
-                    col = img.getpixel((hbyte*self.args.ratio+i, vpos))
-                    bval <<= int(8/self.args.ratio)
-                    bval |= col
-                assert bval<256, "Error: byte value greater then 255, consider changing color ratio!"
-                line.append(bval)
-                no_bytes += 1
-                if not (no_bytes+16)%4096:
-                    line.extend(0 for _ in range(16))
-            lines.append(line)
-        self.lines = lines
         for color in color_generator():
             self.colors.append(color)
+            self.atari_colors.append(RGB2AtariColorConverter(color).value)
     
     # image.width / ratio = bytes per row
 
+    def pack_rows(self, img):
+        "Pack pixel indices of all image rows into bytes"
+        ratio = self.options.ratio
+        bits = int(8/ratio)
+        width = int(img.width/ratio)*ratio
+        pixels = img.tobytes()
+        rows = []
+        for vpos in range(0, img.height):
+            row = pixels[vpos*img.width: vpos*img.width+width]
+            line = [0]*(width//ratio)
+            for i in range(0, ratio):
+                line = [(bval << bits) | col for bval, col in zip(line, row[i::ratio])]
+            assert not line or max(line)<256, "Error: byte value greater then 255, consider changing color ratio!"
+            rows.append(bytes(line))
+        return rows
+
+    @staticmethod
+    def pad_lines(rows):
+        "Split rows into lines, 16 zero bytes are inserted 16 bytes before each 4K boundary"
+        lines = []
+        no_bytes = 0
+        for row in rows:
+            line = list(row)
+            boundary = ((DisplayList.BOUNDARY - 16 - no_bytes - 1) % DisplayList.BOUNDARY) + 1
+            if boundary <= len(row):
+                line[boundary:boundary] = [0]*16
+            no_bytes += len(row)
+            lines.append(line)
+        return lines
+
+    def load(self):
+        "Load source image"
+        if isinstance(self.source, Image.Image):
+            return self.source
+        source = self.source.read() if hasattr(self.source, 'read') else self.source
+        self.stats.count('source', len(source))
+        img = Image.open(io.BytesIO(source))
+        img.load()
+        return img
+
     def lines_to_bytearray(self):
         "Convert all lines to single bytearray" 
         data = bytearray()
@@ -143,23 +246,46 @@ class AtariImageConverter:
         log().debug('Compressing image data')
         data = self.lines_to_bytearray()
         log().info('Data size: %d', len(data))
-        compressor = self.compressor_cls(data)
-        self.compressed = compressor.compress()
+        with self.stats.timer('compress'):
+            compressor = self.compressor_cls(data)
+            self.compressed = compressor.compress()
+        self.stats.count('compressed', len(self.compressed))
+        self.stats.add_compressor_stats(compressor.stats)
         sc = len(self.compressed)
         su = len(data)
         rc = sc / su
-        if self.args.verbose:
+        if self.options.verbose:
             print("Size: {} Packed: {} Ratio: {:.2f}".format(su, sc, rc))
         log().info('Size: %d Packed: %d Ratio: %d', su, sc, rc)
+        if self.options.inplace:
+            with self.stats.timer('inplace'):
+                self.layout = compressor.inplace(self.compressed)
+            if self.options.verbose:
+                print("In-place offset: {} Margin: {}".format(*self.layout))
+            log().info('In-place offset: %d Margin: %d', *self.layout)
 
-    def __write(self, value):
-        self.args.destination.write(("{}{}".format(value, os.linesep)).encode())
+    def _write(self, value):
+        self.output.append(("{}{}".format(value, os.linesep)).encode())
 
-    def __write_text(self, text):
+    def _write_text(self, text):
         for i in text.splitlines():
-            self.__write(i)
+            self._write(i)
+
+    @staticmethod
+    def generate_data_lines(data, n):
+        "Generator for asm data lines of n bytes, values are numbers or asm expressions"
+        lines = [data[i*n: i*n+n] for i in range(len(data)//n+(1 if len(data)%n else 0))]
+        for line in lines:
+            yield "\t\t.byte {}".format(",".join(i if isinstance(i, str) else "${:02x}".format(i) for i in line))
+
+    def write_table(self, name, values, comment=None):
+        "Append table of byte values as local block"
+        self._write("\t.local {}{}".format(name, ' ; {}'.format(comment) if comment else ''))
+        for line in self.generate_data_lines(values, self.options.number):
+            self._write(line)
+        self._write("\t.endl")
     
-    def __save_asm(self):
+    def _save_asm(self):
         "Save image data as asm"
         log().debug('Saving image data to file')
 
@@ -168,99 +294,148 @@ class AtariImageConverter:
             for line in lines:
                 yield "\t\t.byte {}".format(",".join("${:02x}".format(i) for i in line))
 
-        def generate_compressed_lines(data):
-            "Generator for compressed asm data lines"
-            n = self.args.number
-            lines = [data[i*n: i*n+n] for i in range(len(data)//n+(1 if len(data)%n else 0))]
-            for line in lines:
-                yield "\t\t.byte {}".format(",".join("${:02x}".format(i) for i in line))
-
-        if self.args.align:
-            self.__write("\t.align $1000")
+        if self.options.align:
+            self._write("\t.align $1000")
 
-        self.__write("\t.local image_{} ; width={} height={}".format(
-                     self.args.label, self.width, self.height))
+        if self.options.compress and self.layout:
+            self._write("\t.local image_{} ; width={} height={} in-place offset={} margin={}".format(
+                         self.options.label, self.width, self.height, *self.layout))
+            self._write("\t\t.ds {}".format(self.layout.offset))
+            self._write("packed")
+        else:
+            self._write("\t.local image_{} ; width={} height={}".format(
+                         self.options.label, self.width, self.height))
 
-        generated_lines = generate_lines(self.lines) if not self.args.compress else \
-                          generate_compressed_lines(self.compressed)
+        generated_lines = generate_lines(self.lines) if not self.options.compress else \
+                          self.generate_data_lines(self.compressed, self.options.number)
         
         for line in generated_lines:
-            self.__write(line)
+            self._write(line)
         
-        self.__write("\t.endl")
+        self._write("\t.endl")
         self.write_dlist()
         self.write_colors()
         self.write_uncompress()
 
     def write_uncompress(self):
         "Write uncompress routine"
-        if self.args.uncompress:
-            log().debug('Saving uncompress routine')
-            uncompress = self.compressor_cls.uncompress()
-            contents = uncompress.assembly.splitlines()
-            for content in contents:
-                print(content, file=self.args.uncompress)
+        log().debug('Saving uncompress routine')
+        uncompress = self.compressor_cls.uncompress()
+        self.uncompress = "".join("{}\n".format(content) for content in uncompress.assembly.splitlines())
             
     def write_colors(self):
         "Append color information"
         log().debug('Saving color palette')
-        self.__write("\t.local colors_{}".format(self.args.label))
-        for index, color in enumerate(self.colors):
-            clr = (index, *(RGB2AtariColorConverter(color).value[:4]))
-            self.__write("c{}\t\t.byte ${:02x}".format(index, clr[-1]))
-            if self.args.verbose:
+        self._write("\t.local colors_{}".format(self.options.label))
+        for index, color in enumerate(self.atari_colors):
+            clr = (index, *(color[:4]))
+            self._write("c{}\t\t.byte ${:02x}".format(index, clr[-1]))
+            if self.options.verbose:
                 print("Color {} [{:02x}{:02x}{:02x}] = {}".format(*clr))
-        self.__write("\t.endl")
+        self._write("\t.endl")
 
     def write_dlist(self):
         "Append display list"
         log().debug('Saving display list')
-        if self.args.display_list and not self.args.compress:
-            if self.args.align:
-                self.__write("\t.align $400")
-            self.__write_text("""\t.local dlist_{label}
-:3		.byte $70
-		.byte $4{antic}, a(image_{label})
-:101	.byte $0{antic}
-		.byte $4{antic}, a(image_{label}+$1000)
-:89		.byte $0{antic}
-		.byte $41, a(dlist_{label})
-\t.endl""".format(label=self.args.label, antic=hex(self.args.antic_mode)[-1]))
-
-    def __save_bin(self):
+        if self.options.display_list and not self.options.compress:
+            if self.options.align:
+                self._write("\t.align $400")
+            for line in self.build_dlist().generate_lines():
+                self._write(line)
+
+    def build_dlist(self):
+        "Build display list, every line following 4K boundary padding gets LMS"
+        dlist = DisplayList(self.options.label)
+        dlist.blank()
+        interrupts = self.dlist_interrupts()
+        offset = 0
+        padded = True
+        for vpos, (row, line) in enumerate(zip(self.rows, self.lines)):
+            address = None
+            if padded:
+                address = 'image_{}'.format(self.options.label) if not offset else \
+                          'image_{}+${:x}'.format(self.options.label, offset)
+            dlist.mode_line(self.options.antic_mode, address, vpos in interrupts)
+            offset += len(line)
+            padded = len(line) > len(row)
+        return dlist
+
+    def dlist_interrupts(self):
+        "Return mode line numbers with display list interrupt bit set"
+        return set()
+
+    def _save_bin(self):
         "Save binary data"
-        if not self.args.compress:
+        if not self.options.compress:
             data = self.lines_to_bytearray()
-            self.args.destination.write(data)
+            self.output.append(data)
             log().debug('Saved raw file')
         else:
-            self.args.destination.write(self.compressed)
+            self.output.append(self.compressed)
             log().debug('Saved compressed file')
 
     def save(self):
         "Save image data"
-        if self.args.type == 'asm':
-            log().debug('Saving asm file')
-            self.__save_asm()
-        elif self.args.type == 'bin':
-            log().debug('Saving binary file')
-            self.__save_bin()
+        with self.stats.timer('emit'):
+            if self.options.type == 'asm':
+                log().debug('Saving asm file')
+                self._save_asm()
+            elif self.options.type == 'bin':
+                log().debug('Saving binary file')
+                self._save_bin()
+                self.write_uncompress()
+
+    def packed_blocks(self):
+        "Return list of stored (compressed or plain) data blocks"
+        return [bytes(self.compressed if self.options.compress else self.lines_to_bytearray())]
+
+    def result(self):
+        "Return conversion result"
+        packed = self.packed_blocks()
+        metadata = {
+            'label': self.options.label,
+            'width': self.width,
+            'height': self.height,
+            'bytes_per_line': self.bytes_per_line,
+            'colors': [color[3] for color in self.atari_colors],
+            'compressor': self.options.compressor if self.options.compress else None,
+            'size': len(self.lines_to_bytearray()),
+            'packed': sum(len(block) for block in packed),
+        }
+        if self.layout:
+            metadata['inplace'] = dict(self.layout._asdict())
+        return Result(data=b''.join(self.output),
+                      packed=packed,
+                      uncompress=self.uncompress,
+                      metadata=metadata,
+                      stats=self.stats)
 
 def add_parser_args(parser):
     "Add cli arguments to parser"
     parser.add_argument('-s', '--source', type=argparse.FileType('rb'), help='path to source gif file', required=True)
     parser.add_argument('-d', '--destination', type=argparse.FileType('wb'), help='path to destination asm file', required=True)
-    parser.add_argument('-n', '--number', type=int, default=20, help='number of bytes per line for compressed data')
-    parser.add_argument('-l', '--label', help='label name', default='1')
+    parser.add_argument('-n', '--number', type=int, help='number of bytes per line for compressed data')
+    parser.add_argument('-l', '--label', help='label name')
     parser.add_argument('-i', '--display-list', help='generate display list in asm file (uncompressed only)', action='store_true')
-    parser.add_argument('-r', '--ratio', help='color ratio (8/ratio=colors per byte)', type=int, choices=(8,4,2), default=4)
-    parser.add_argument('-t', '--type', choices=('asm', 'bin'), help='select output type', default='asm')
+    parser.add_argument('-r', '--ratio', help='color ratio (8/ratio=colors per byte)', type=int, choices=(8,4,2))
+    parser.add_argument('-t', '--type', choices=('asm', 'bin'), help='select output type')
     parser.add_argument('-e', '--verbose', action='store_true', help='generate more verbose output')
-    parser.add_argument('-m', '--compressor', choices=('legacy', 'lz4'), help='select compress type', default='legacy')
+    parser.add_argument('-m', '--compressor', choices=('legacy', 'lz4', 'lz4-fast', 'hybrid', 'hybrid-lz4'), help='select compress type')
     parser.add_argument('-c', '--compress', help='compress data', action='store_true')
     parser.add_argument('-u', '--uncompress', help='save routine for data uncompress', type=argparse.FileType('w'))
-    parser.add_argument('-o', '--antic-mode', help='set antic mode', type=int, choices=(13,14,15), default=14)
+    parser.add_argument('-p', '--inplace', help='place compressed data inside decode buffer (bitmap modes)', action='store_true')
+    parser.add_argument('-o', '--antic-mode', help='set antic mode', type=int, choices=(13,14,15))
     parser.add_argument('-a', '--align', help='include .align command (uncompressed only)', action='store_true')
+    parser.add_argument('-M', '--mode', choices=('bitmap', 'charset', 'pmg', 'dli', 'dedup', 'map'), help='select conversion mode')
+    parser.add_argument('-b', '--error-budget', type=int, help='max differing pixels for merging glyphs (charset mode)')
+    parser.add_argument('-W', '--frame-width', type=int, help='sprite frame width in pixels, multiple of 8 (pmg mode)')
+    parser.add_argument('-H', '--frame-height', type=int, help='sprite frame height in pixels, 0 for sheet height (pmg mode)')
+    parser.add_argument('-S', '--strip', choices=('rows', 'columns'), help='map strips: rows scroll vertically, columns horizontally (map mode)')
+    parser.add_argument('-Z', '--strip-size', type=int, help='strip size in scanlines (rows) or bytes (columns) (map mode)')
+    parser.add_argument('-w', '--window', type=int, help='visible scanlines (rows) or fetched bytes per line (columns), 0 for 192/48 (map mode)')
+    parser.add_argument('--stats', choices=('json',), help='print conversion statistics in given format')
+    parser.add_argument('--profile', help='profile conversion and print hottest functions', action='store_true')
+    parser.set_defaults(**ImageOptions.DEFAULTS)
 
 def get_parser():
     "Create parser and add cli arguments"
@@ -268,13 +443,27 @@ def get_parser():
     add_parser_args(parser)
     return parser  
 
+def convert_image(source, options=None, **kwargs):
+    "Convert gif image (bytes, file object or PIL image) and return conversion result"
+    options = (options or ImageOptions()).replace(**kwargs)
+    img_converter = AtariImageConverter.create_converter(options.mode)(options, source)
+    result = run_converter(img_converter)
+    img_converter.stats.finish()
+    return result
+
 def process(args):
     "Main processing"
     log().debug("Start processing")
-    img_converter = AtariImageConverter(args)
-    img_converter.process()
-    img_converter.compress()
-    img_converter.save()
+    options = ImageOptions.from_args(args)
+    img_converter = AtariImageConverter.create_converter(options.mode)(options, args.source)
+    if args.profile:
+        result = profile(run_converter, img_converter)
+    else:
+        result = run_converter(img_converter)
+    result.write(args.destination, args.uncompress)
+    img_converter.stats.finish()
+    if args.stats == 'json':
+        print(result.stats.to_json())
     log().debug("Done")
 
 def main():
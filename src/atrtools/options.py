@@ -0,0 +1,65 @@
+"""
+Conversion options and results used by library API.
+Converters accept any object with option attributes, cli argparse namespace included.
+"""
+
+import logging
+
+
+def log():
+    return logging.getLogger(__name__)
+
+
+class Options:
+    "Generic conversion options"
+    DEFAULTS = {}
+
+    def __init__(self, **kwargs):
+        unknown = set(kwargs) - set(self.__class__.DEFAULTS)
+        if unknown:
+            raise TypeError('Unknown options: {}'.format(', '.join(sorted(unknown))))
+        for name, value in dict(self.__class__.DEFAULTS, **kwargs).items():
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__,
+                               ', '.join('{}={!r}'.format(k, getattr(self, k)) for k in self.__class__.DEFAULTS))
+
+    def replace(self, **kwargs):
+        "Return copy of options with given values replaced"
+        values = {name: getattr(self, name) for name in self.__class__.DEFAULTS}
+        values.update(kwargs)
+        return self.__class__(**values)
+
+    @classmethod
+    def from_args(cls, args):
+        "Create options from parsed cli arguments"
+        return cls(**{name: getattr(args, name) for name in cls.DEFAULTS if hasattr(args, name)})
+
+
+class Result:
+    "Conversion result, packed is list of stored (compressed or plain) data blocks"
+
+    def __init__(self, data, packed, uncompress, metadata, stats):
+        self.data = data
+        self.packed = packed
+        self.uncompress = uncompress
+        self.metadata = metadata
+        self.stats = stats
+
+    def __repr__(self):
+        return '{}(data={} bytes, metadata={})'.format(self.__class__.__name__, len(self.data), self.metadata)
+
+    @property
+    def asm(self):
+        "Return asm output as text"
+        return self.data.decode()
+
+    def write(self, destination, uncompress=None):
+        "Write output to destination and uncompress routine to given text files"
+        log().debug('Writing conversion result')
+        with self.stats.timer('write'):
+            destination.write(self.data)
+            self.stats.count('written', len(self.data))
+            if uncompress:
+                uncompress.write(self.uncompress)
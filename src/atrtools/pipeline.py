@@ -0,0 +1,191 @@
+"""
+Batch conversion pipeline.
+Overlaps source reads, conversions (in worker processes) and output writes of many assets with asyncio,
+bounded queues between stages keep only a few assets in memory.
+"""
+
+import os
+import re
+import time
+import asyncio
+import argparse
+import logging
+import collections
+import concurrent.futures
+
+from atrtools.imgconv import (AtariImageConverter, ImageOptions)
+from atrtools.sapconv import (AtariSAPConverter, SAPOptions)
+from atrtools.stats import run_converter
+
+
+def log():
+    return logging.getLogger(__name__)
+
+
+Asset = collections.namedtuple('Asset', 'name source destination uncompress')
+
+
+def convert_asset(asset, data, image_options, sap_options):
+    "Convert source data of asset in worker process, statistics hooks are notified by pipeline"
+    if asset.source.lower().endswith('.sap'):
+        converter = AtariSAPConverter(sap_options, data)
+    else:
+        options = image_options.replace(label=re.sub(r'\W', '_', asset.name))
+        converter = AtariImageConverter.create_converter(options.mode)(options, data)
+    return run_converter(converter)
+
+
+class Pipeline:
+    "Read, convert and write stages connected by bounded queues"
+
+    def __init__(self, image_options=None, sap_options=None, workers=2, queue_size=4):
+        self.image_options = image_options or ImageOptions()
+        self.sap_options = sap_options or SAPOptions()
+        self.workers = workers
+        self.queue_size = queue_size
+        self.written = []
+
+    def assets(self, sources, destination, uncompress=False):
+        "Return assets for source paths, outputs are named after sources in destination directory"
+        assets = []
+        for source in sources:
+            name = os.path.splitext(os.path.basename(source))[0]
+            sap = source.lower().endswith('.sap')
+            output_type = self.sap_options.type if sap else self.image_options.type
+            assets.append(Asset(name, source, os.path.join(destination, '{}.{}'.format(name, output_type)),
+                                os.path.join(destination, '{}_uncompress.asm'.format(name)) if uncompress else None))
+        names = [asset.name for asset in assets]
+        assert len(set(names)) == len(names), "Error: sources {} share output names!".format(
+            ', '.join(sorted(set(name for name in names if names.count(name) > 1))))
+        return assets
+
+    @staticmethod
+    def read(path):
+        with open(path, 'rb') as source:
+            return source.read()
+
+    @staticmethod
+    def write(asset, result):
+        with open(asset.destination, 'wb') as destination:
+            if asset.uncompress:
+                with open(asset.uncompress, 'w') as uncompress:
+                    result.write(destination, uncompress)
+            else:
+                result.write(destination)
+
+    async def reader(self, assets, loaded, executor):
+        "Prefetch sources, waits when loaded queue is full"
+        loop = asyncio.get_running_loop()
+        for asset in assets:
+            data = await loop.run_in_executor(executor, self.read, asset.source)
+            log().debug('Read %s: %d bytes', asset.source, len(data))
+            await loaded.put((asset, data))
+        for _ in range(self.workers):
+            await loaded.put(None)
+
+    async def converter(self, loaded, converted, executor):
+        "Convert loaded sources, waits when converted queue is full"
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await loaded.get()
+            if item is None:
+                await converted.put(None)
+                return
+            asset, data = item
+            result = await loop.run_in_executor(executor, convert_asset, asset, data,
+                                                self.image_options, self.sap_options)
+            log().debug('Converted %s', asset.name)
+            await converted.put((asset, result))
+
+    async def writer(self, converted, executor):
+        "Drain converted results to output files, statistics hooks run in event loop thread"
+        loop = asyncio.get_running_loop()
+        finished = 0
+        while finished < self.workers:
+            item = await converted.get()
+            if item is None:
+                finished += 1
+                continue
+            asset, result = item
+            await loop.run_in_executor(executor, self.write, asset, result)
+            result.stats.finish()
+            log().debug('Written %s: %d bytes', asset.destination, len(result.data))
+            self.written.append((asset, len(result.data), sum(len(block) for block in result.packed)))
+
+    async def run_async(self, assets):
+        "Run all stages until every asset is written"
+        loaded = asyncio.Queue(self.queue_size)
+        converted = asyncio.Queue(self.queue_size)
+        with concurrent.futures.ThreadPoolExecutor(2) as io_executor, \
+             concurrent.futures.ProcessPoolExecutor(self.workers) as executor:
+            tasks = [asyncio.ensure_future(self.reader(assets, loaded, io_executor)),
+                     asyncio.ensure_future(self.writer(converted, io_executor))]
+            tasks.extend(asyncio.ensure_future(self.converter(loaded, converted, executor))
+                         for _ in range(self.workers))
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                raise
+        return self.written
+
+    def run(self, assets):
+        "Convert assets and return list of (asset, output size, packed size) in write order"
+        assert self.workers > 0 and self.queue_size > 0, "Error: workers and queue size must be positive!"
+        self.written = []
+        return asyncio.run(self.run_async(assets))
+
+
+def convert_batch(sources, destination, image_options=None, sap_options=None, workers=2, queue_size=4,
+                  uncompress=False):
+    "Convert gif and sap files to destination directory and return list of written assets"
+    pipeline = Pipeline(image_options, sap_options, workers, queue_size)
+    return pipeline.run(pipeline.assets(sources, destination, uncompress))
+
+
+def add_parser_args(parser):
+    "Add cli arguments to parser"
+    parser.add_argument('-s', '--sources', nargs='+', help='paths to source gif and sap files', required=True)
+    parser.add_argument('-d', '--destination', help='path to destination directory', required=True)
+    parser.add_argument('-t', '--type', choices=('asm', 'bin'), default='asm', help='select output type')
+    parser.add_argument('-r', '--ratio', help='color ratio (8/ratio=colors per byte)', type=int, choices=(8,4,2),
+                        default=4)
+    parser.add_argument('-c', '--compress', help='compress data', action='store_true')
+    parser.add_argument('-m', '--compressor', choices=('legacy', 'lz4', 'lz4-fast', 'hybrid', 'hybrid-lz4'), default='legacy', help='select compress type')
+    parser.add_argument('-u', '--uncompress', help='save uncompress routine next to every output', action='store_true')
+    parser.add_argument('-j', '--workers', type=int, default=2, help='number of conversion worker processes (default 2)')
+    parser.add_argument('-q', '--queue-size', type=int, default=4,
+                        help='max assets waiting between stages, bounds memory (default 4)')
+    parser.add_argument('-e', '--verbose', action='store_true', help='generate more verbose output')
+
+def get_parser():
+    "Create parser and add cli arguments"
+    parser = argparse.ArgumentParser()
+    add_parser_args(parser)
+    return parser
+
+def process(args):
+    "Main processing"
+    log().debug("Start processing")
+    os.makedirs(args.destination, exist_ok=True)
+    start = time.perf_counter()
+    written = convert_batch(args.sources, args.destination,
+                            ImageOptions(type=args.type, ratio=args.ratio, compress=args.compress,
+                                         compressor=args.compressor),
+                            SAPOptions(type=args.type, compress=args.compress, compressor=args.compressor),
+                            args.workers, args.queue_size, args.uncompress)
+    if args.verbose:
+        for asset, size, packed in written:
+            print("{}: Output: {} Packed: {}".format(asset.destination, size, packed))
+        print("Assets: {} Time: {:.3f}s".format(len(written), time.perf_counter() - start))
+    log().debug("Done")
+
+def main():
+    "Parse arguments and process data"
+    parser = get_parser()
+    args = parser.parse_args()
+    process(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""
+Player/missile graphics converter.
+Splits sprite sheet gif into 8-pixel wide player strips per frame.
+"""
+
+import logging
+import collections
+
+from PIL import Image
+
+from atrtools.imgconv import AtariImageConverter
+
+
+def log():
+    return logging.getLogger(__name__)
+
+
+PMGFrame = collections.namedtuple('PMGFrame', 'top height strips colors')
+
+
+class AtariPMGConverter(AtariImageConverter):
+    "Atari player/missile graphics converter class"
+
+    PLAYER_WIDTH = 8
+
+    def __init__(self, options, source):
+        super().__init__(options, source)
+        self.frames = []
+        self.sheet = []
+        self.data = b''
+
+    @property
+    def frame_width(self):
+        return self.options.frame_width
+
+    @property
+    def frame_height(self):
+        return self.options.frame_height or self.height
+
+    @property
+    def players(self):
+        return self.frame_width // self.__class__.PLAYER_WIDTH
+
+    def pack(self, img):
+        "Cut sheet into frames of player strips"
+        assert not self.frame_width % self.__class__.PLAYER_WIDTH, \
+            "Error: frame width must be multiple of {}!".format(self.__class__.PLAYER_WIDTH)
+        assert not self.width % self.frame_width and not self.height % self.frame_height, \
+            "Error: sheet size must be multiple of frame size!"
+        pixels = img.tobytes()
+        bitmap = Image.frombytes('L', img.size, pixels.translate(bytes([0] + [255]*255))).point(
+            lambda value: 255 if value else 0, '1').tobytes()
+        stride = (self.width + 7) // 8
+        unique = {}
+        for top in range(0, self.height, self.frame_height):
+            for left in range(0, self.width, self.frame_width):
+                strips = tuple(bitmap[top*stride + column: (top+self.frame_height)*stride: stride]
+                               for column in range(left//8, (left+self.frame_width)//8))
+                frame = self.trim(strips, self.frame_colors(pixels, left, top))
+                self.sheet.append(unique.setdefault(frame, len(unique)))
+        self.frames = list(unique)
+        self.data = b''.join(b''.join(frame.strips) for frame in self.frames)
+        self.stats.count('packed', len(self.data))
+        log().info('Frames: %d Unique: %d', len(self.sheet), len(self.frames))
+        if self.options.verbose:
+            print("Frames: {} Unique: {} Players: {}".format(len(self.sheet), len(self.frames), self.players))
+
+    @staticmethod
+    def trim(strips, colors):
+        "Remove empty rows above and below frame"
+        rows = [any(values) for values in zip(*strips)]
+        if not any(rows):
+            return PMGFrame(0, 0, tuple(b'' for _ in strips), colors)
+        top = rows.index(True)
+        bottom = len(rows) - rows[::-1].index(True)
+        return PMGFrame(top, bottom-top, tuple(strip[top:bottom] for strip in strips), colors)
+
+    def frame_colors(self, pixels, left, top):
+        "Return most common non-zero palette index of every player strip of frame"
+        colors = []
+        for column in range(left, left+self.frame_width, self.__class__.PLAYER_WIDTH):
+            strip = b''.join(pixels[row*self.width + column: row*self.width + column + self.__class__.PLAYER_WIDTH]
+                             for row in range(top, top+self.frame_height))
+            counts = collections.Counter(strip.translate(None, b'\x00'))
+            colors.append(counts.most_common(1)[0][0] if counts else 0)
+        return tuple(colors)
+
+    def compress(self):
+        "Compress player strip data"
+        log().debug('Compressing player data')
+        with self.stats.timer('compress'):
+            compressor = self.compressor_cls(self.data)
+            self.compressed = compressor.compress()
+        self.stats.count('compressed', len(self.compressed))
+        self.stats.add_compressor_stats(compressor.stats)
+        if self.options.verbose and self.data:
+            print("Size: {} Packed: {} Ratio: {:.2f}".format(len(self.data), len(self.compressed),
+                                                             len(self.compressed) / len(self.data)))
+        log().info('Size: %d Packed: %d', len(self.data), len(self.compressed))
+
+    def _save_asm(self):
+        "Save player tables and data as asm"
+        log().debug('Saving player data to file')
+        offsets = []
+        offset = 0
+        for frame in self.frames:
+            offsets.append(offset)
+            offset += frame.height * self.players
+
+        self._write("\t; frames={} unique={} players={} width={} height={}".format(
+                    len(self.sheet), len(self.frames), self.players, self.frame_width, self.frame_height))
+        label = self.options.label
+        self.write_table('pmg_frames_{}'.format(label), self.sheet, 'unique frame number per sheet frame')
+        self.write_table('pmg_heights_{}'.format(label), [frame.height for frame in self.frames],
+                         'height per unique frame')
+        self.write_table('pmg_tops_{}'.format(label), [frame.top for frame in self.frames],
+                         'empty rows trimmed above unique frame')
+        self.write_table('pmg_data_lo_{}'.format(label), [value & 0xff for value in offsets],
+                         'data offset (low) per unique frame, players follow by height')
+        self.write_table('pmg_data_hi_{}'.format(label), [value >> 8 for value in offsets],
+                         'data offset (high) per unique frame')
+        self.write_table('pmg_colors_{}'.format(label),
+                         [self.atari_colors[color][3] if color < len(self.atari_colors) else 0
+                          for frame in self.frames for color in frame.colors],
+                         'color per unique frame and player')
+
+        self._write("\t.local pmg_data_{} ; {}".format(self.options.label,
+                                                        'compressed' if self.options.compress else 'raw'))
+        for line in self.generate_data_lines(self.compressed if self.options.compress else self.data,
+                                             self.options.number):
+            self._write(line)
+        self._write("\t.endl")
+        self.write_colors()
+        self.write_uncompress()
+
+    def _save_bin(self):
+        "Save player strip data"
+        self.output.append(self.compressed if self.options.compress else self.data)
+        log().debug('Saved player data')
+
+    def packed_blocks(self):
+        "Return player data"
+        return [bytes(self.compressed if self.options.compress else self.data)]
+
+    def result(self):
+        "Return conversion result"
+        result = super().result()
+        result.metadata.update({
+            'size': len(self.data),
+            'frames': list(self.sheet),
+            'players': self.players,
+            'heights': [frame.height for frame in self.frames],
+            'tops': [frame.top for frame in self.frames],
+        })
+        return result
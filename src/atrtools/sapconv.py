@@ -9,20 +9,24 @@ import argparse
 import logging
 import itertools
 
-from atrtools.compress import (LegacyCompress, Lz4Compress, Compress)
+from atrtools.compress import (LegacyCompress, Lz4Compress, StreamCompress, Compress)
+from atrtools.stats import (Stats, run_converter, profile)
+from atrtools.options import (Options, Result)
 
 RGX = re.compile(r'([A-Z]*)\s"?([^"]*)')
+HEADER_LINE = re.compile(rb'[A-Z]+([ \t][^\r\n\xff]*)?')
     
 def log():
 	return logging.getLogger(__name__)
 
 
 class MusicData:
-    def __init__(self, address_start, address_end, music_data, compressed_data=None):
+    def __init__(self, address_start, address_end, music_data, compressed_data=None, layout=None):
         self.__address_start = address_start
         self.__address_end = address_end
         self.__music_data = music_data
         self.__compressed_data = compressed_data
+        self.__layout = layout
 
     @property
     def address_start(self):
@@ -56,24 +60,107 @@ class MusicData:
     def compressed_data(self, value):
         self.__compressed_data = value
 
+    @property
+    def layout(self):
+        return self.__layout
+
+    @layout.setter
+    def layout(self, value):
+        self.__layout = value
+
+
+
+class RegisterData:
+    "POKEY register dump (SAP type R) stored as one column stream per register"
+
+    NAMES = ('AUDF1', 'AUDC1', 'AUDF2', 'AUDC2', 'AUDF3', 'AUDC3', 'AUDF4', 'AUDC4', 'AUDCTL')
+    STEREO_OFFSET = 0x10
+    SCANLINES = {'PAL': 312, 'NTSC': 262}
+
+    def __init__(self, frames, columns, fastplay=312, scanlines=312):
+        self.frames = frames
+        self.columns = columns
+        self.fastplay = fastplay
+        self.calls = scanlines // fastplay
+        self.transforms = [None]*len(columns)
+        self.streams = [None]*len(columns)
+
+    @property
+    def channels(self):
+        return len(self.columns)
+
+    def name(self, channel):
+        "Return register name of channel, second pokey registers are suffixed"
+        names = self.__class__.NAMES
+        return names[channel] if channel < len(names) else '{}_2'.format(names[channel - len(names)])
+
+    def register(self, channel):
+        "Return register offset of channel from pokey base"
+        names = self.__class__.NAMES
+        return channel if channel < len(names) else self.__class__.STEREO_OFFSET + channel - len(names)
+
+    @staticmethod
+    def delta(column):
+        "Return column as differences (mod 256) of consecutive frames"
+        return bytes((value - previous) & 0xff for previous, value in zip(b'\x00' + column, column))
+
     
+class SAPOptions(Options):
+    "SAP conversion options"
+    DEFAULTS = {
+        'labels': ['INIT', 'PLAYER'],
+        'type': 'asm',
+        'verbose': False,
+        'compress': False,
+        'compressor': 'legacy',
+        'inplace': False,
+    }
+
+
 class AtariSAPConverter:
     "Atari SAP Converter class"
     
-    def __init__(self, args):
-        self.args=args
-        self.sap=args.source.read()
+    def __init__(self, options, source):
+        "Construct converter from options and sap source (bytes or file object)"
+        self.options = options
+        self.source = source
+        self.stats = Stats('sapconv')
+        self.sap = None
         self.header = {}
         self.labels = {}
         self.data = []
-        self.compressor_cls = Compress.create_compressor(self.args.compressor)
+        self.type = None
+        self.stereo = False
+        self.registers = None
+        self.output = []
+        self.uncompress = None
+        self.compressor_cls = Compress.create_compressor(self.options.compressor)
 
     def process(self):
+        "Process music data"
+        with self.stats.timer('load'):
+            self.sap = self.source.read() if hasattr(self.source, 'read') else bytes(self.source)
+        self.stats.count('source', len(self.sap))
+        with self.stats.timer('pack'):
+            self.__process()
+        self.stats.count('packed', sum(len(data.music_data) for data in self.data) if not self.registers else
+                         self.registers.frames * self.registers.channels)
+
+    def __header_end(self):
+        "Return index of data following header lines"
+        index = 0
+        while True:
+            end = self.sap.find(b'\r\n', index)
+            if end < 0 or not HEADER_LINE.fullmatch(self.sap[index:end]):
+                return index
+            index = end + 2
+
+    def __process(self):
         log().debug('Processing music data')
         assert self.sap[0:3] == b'SAP', 'This is not a SAP file!'
-        index = self.sap.index(b'\xff\xff')
+        index = self.__header_end()
 
-        if self.args.verbose:
+        if self.options.verbose:
             print("Binary index: %d" % index)
             print("Binary data total length: %d" % len(self.sap))
         logging.debug("Binary index: %d", index)
@@ -86,22 +173,29 @@ class AtariSAPConverter:
                 k = match.group(1).upper()
                 v  = match.group(2).upper()
                 if k == 'TYPE':
-                    assert v == 'B', 'Type {} is not supported'.format(v)
-                if k in self.args.labels:
+                    assert v in ('B', 'R'), 'Type {} is not supported'.format(v)
+                    self.type = v
+                if k in self.options.labels:
                     self.labels[k] = v
                 else:
                     self.header[k] = v
-        index +=2
+        self.stereo = 'STEREO' in header.split('\r\n')
 
         for label in self.labels:
                 logging.debug("%s: %s", label, self.labels[label])
-                if self.args.verbose:
+                if self.options.verbose:
                     print("{}: {}".format(label, self.labels[label]))
         for header in self.header:
                 logging.debug("%s: %s", header, self.header[header])
-                if self.args.verbose:
+                if self.options.verbose:
                     print("{}: {}".format(header, self.header[header]))
 
+        if self.type == 'R':
+            self.__process_registers(index)
+            return
+
+        assert self.sap[index:index+2] == b'\xff\xff', 'Binary data not found!'
+        index +=2
         while True:
             beg_byte_low, beg_byte_high = self.sap[index:index+2]
             index += 2
@@ -110,7 +204,7 @@ class AtariSAPConverter:
             address_start = "{:02x}{:02x}".format(beg_byte_high, beg_byte_low)
             address_end = "{:02x}{:02x}".format(end_byte_high, end_byte_low)
             size_bytes = (end_byte_high*256+end_byte_low)-(beg_byte_high*256+beg_byte_low)
-            if self.args.verbose:
+            if self.options.verbose:
                 print("Start address: $%s" % address_start)
                 print("End address: $%s" % address_end)
                 print("Size: $%04x" % size_bytes)
@@ -126,6 +220,32 @@ class AtariSAPConverter:
             if index == len(self.sap)-1:
                 break
 
+    def __fastplay(self):
+        "Return FASTPLAY scanlines and frame scanlines, player calls must fit frame evenly"
+        ntsc = b'NTSC' in self.sap[0:self.__header_end()].split(b'\r\n')
+        scanlines = RegisterData.SCANLINES['NTSC' if ntsc else 'PAL']
+        value = self.header.get('FASTPLAY', self.labels.get('FASTPLAY', str(scanlines)))
+        fastplay = int(value) if value.isdigit() else 0
+        if not fastplay or scanlines % fastplay:
+            raise ValueError("Error: FASTPLAY {} does not divide {} scanlines frame, "
+                             "player calls cannot be timed!".format(value, scanlines))
+        return fastplay, scanlines
+
+    def __process_registers(self, index):
+        "Split register dump into per-register columns"
+        channels = len(RegisterData.NAMES) * (2 if self.stereo else 1)
+        fastplay, scanlines = self.__fastplay()
+        dump = self.sap[index:]
+        frames = len(dump) // channels
+        assert frames < 0x10000, 'Too many frames: {}'.format(frames)
+        if len(dump) % channels:
+            log().warning('Incomplete last frame skipped')
+        self.registers = RegisterData(frames, [dump[channel: frames*channels: channels]
+                                               for channel in range(channels)], fastplay, scanlines)
+        if self.options.verbose:
+            print("Frames: {} Channels: {} Calls per frame: {}".format(frames, channels, self.registers.calls))
+        log().debug("Frames: %d Channels: %d Calls per frame: %d", frames, channels, self.registers.calls)
+
     def generate_music_data(self, data):
         "Music data generator"
         log().debug('Generating music data')
@@ -141,7 +261,7 @@ class AtariSAPConverter:
             yield ".byte {}".format(','.join(bts))
 
     def __write(self, value):
-        self.args.destination.write(("{}{}".format(value, os.linesep)).encode())
+        self.output.append(("{}{}".format(value, os.linesep)).encode())
 
     def __save_asm(self):
         "Save asm file"
@@ -154,66 +274,165 @@ class AtariSAPConverter:
                 self.__write('{}\t.byte "{}"'.format(k, self.header[k]))
         self.__write("\t.endl")
 
+        if self.registers:
+            self.__save_registers_asm()
+
         for idx, data in enumerate(self.data):
-            self.__write("\n\torg ${}\n".format(data.address_start))
-            self.__write("\t.local sap_music_data{} ; start=${}, end=${}".format(idx, 
-                                                                                 data.address_start,
-                                                                                 data.address_end))
-            gen_data = self.generate_music_data(data.compressed_data if self.args.compress else data.music_data)
+            if self.options.compress and data.layout:
+                self.__write("\n\torg ${:04x}\n".format(int(data.address_start, 16) + data.layout.offset))
+                self.__write("\t.local sap_music_data{} ; start=${}, end=${}, in-place offset={} margin={}".format(
+                             idx, data.address_start, data.address_end, *data.layout))
+            else:
+                self.__write("\n\torg ${}\n".format(data.address_start))
+                self.__write("\t.local sap_music_data{} ; start=${}, end=${}".format(idx, 
+                                                                                     data.address_start,
+                                                                                     data.address_end))
+            gen_data = self.generate_music_data(data.compressed_data if self.options.compress else data.music_data)
             for row in gen_data:
                 self.__write("\t{}".format(row))
-            self.__write("\t.endl ; music {} data".format('compressed' if self.args.compress else 'raw'))
+            self.__write("\t.endl ; music {} data".format('compressed' if self.options.compress else 'raw'))
         
         self.write_uncompress()
 
+    def __save_registers_asm(self):
+        "Save register streams with player tables"
+        registers = self.registers
+        channels = range(registers.channels)
+        self.__write("\n\t.local sap_registers ; type=R frames={} channels={}".format(registers.frames,
+                                                                                    registers.channels))
+        self.__write("channels = {}".format(registers.channels))
+        self.__write("fastplay = {}\t; scanlines between play calls".format(registers.fastplay))
+        self.__write("calls = {}\t\t; play calls per frame".format(registers.calls))
+        self.__write("frames_lo\t.byte ${:02x}".format(registers.frames & 0xff))
+        self.__write("frames_hi\t.byte ${:02x}".format(registers.frames >> 8))
+        self.__write("start_lo\t.byte {}".format(','.join('<stream{}'.format(channel) for channel in channels)))
+        self.__write("start_hi\t.byte {}".format(','.join('>stream{}'.format(channel) for channel in channels)))
+        self.__write("delta\t.byte {}".format(','.join(str(int(transform == 'delta'))
+                                                       for transform in registers.transforms)))
+        self.__write("reg\t\t.byte {}".format(','.join('${:02x}'.format(registers.register(channel))
+                                                      for channel in channels)))
+        for channel in channels:
+            self.__write("stream{}\t; {} {} size={} packed={}".format(
+                         channel, registers.name(channel), registers.transforms[channel],
+                         registers.frames, len(registers.streams[channel])))
+            for row in self.generate_music_data(registers.streams[channel]):
+                self.__write("\t{}".format(row))
+        self.__write("\t.endl")
+
     def write_uncompress(self):
         "Write uncompress routine"
-        if self.args.uncompress:
-            log().debug('Saving uncompress routine')
-            uncompress = self.compressor_cls.uncompress()
-            contents = uncompress.assembly.splitlines()
-            for content in contents:
-                print(content, file=self.args.uncompress)
+        log().debug('Saving uncompress routine')
+        uncompress = (self.compressor_cls if not self.registers else StreamCompress).uncompress()
+        self.uncompress = "".join("{}\n".format(content) for content in uncompress.assembly.splitlines())
 
     def __save_bin(self):
         "Save binary file"  
         log().debug('Saving binary music data to file')
         for data in self.data:
-            self.args.destination.write(data.compressed_data if self.args.compress else data.music_data)
+            self.output.append(data.compressed_data if self.options.compress else data.music_data)
+        if self.registers:
+            self.output.extend(self.registers.streams)
 
     def save(self):
         "Save music"
-        if self.args.type == 'asm':
-            self.__save_asm()
-        elif self.args.type == 'bin':
-            self.__save_bin()
+        with self.stats.timer('emit'):
+            if self.options.type == 'asm':
+                self.__save_asm()
+            elif self.options.type == 'bin':
+                self.__save_bin()
+                self.write_uncompress()
+
+    def result(self):
+        "Return conversion result"
+        metadata = {
+            'header': dict(self.header),
+            'labels': dict(self.labels),
+            'compressor': self.options.compressor if self.options.compress else None,
+            'blocks': [{'start': data.address_start,
+                        'end': data.address_end,
+                        'size': len(data.music_data),
+                        'packed': len(data.compressed_data),
+                        'inplace': dict(data.layout._asdict()) if data.layout else None} for data in self.data],
+        }
+        if self.registers:
+            metadata.update({
+                'type': self.type,
+                'frames': self.registers.frames,
+                'fastplay': self.registers.fastplay,
+                'calls': self.registers.calls,
+                'channels': [{'register': self.registers.name(channel),
+                              'transform': self.registers.transforms[channel],
+                              'size': self.registers.frames,
+                              'packed': len(self.registers.streams[channel])}
+                             for channel in range(self.registers.channels)],
+            })
+        return Result(data=b''.join(self.output),
+                      packed=[bytes(data.compressed_data if self.options.compress else data.music_data)
+                              for data in self.data] if not self.registers else
+                             [bytes(stream) for stream in self.registers.streams],
+                      uncompress=self.uncompress,
+                      metadata=metadata,
+                      stats=self.stats)
 
     def compress(self):
         "Compress routine"
         log().debug('Compressing music data')
+        if self.registers:
+            self.__compress_registers()
         for data_block in self.data:
             data = data_block.music_data
             log().info('Data size: %d', len(data))
-            compressor = self.compressor_cls(data)
-            compressed = compressor.compress()
+            with self.stats.timer('compress'):
+                compressor = self.compressor_cls(data)
+                compressed = compressor.compress()
             data_block.compressed_data = compressed
+            if self.options.inplace:
+                with self.stats.timer('inplace'):
+                    data_block.layout = compressor.inplace(compressed)
+                log().info('In-place offset: %d Margin: %d', *data_block.layout)
+            self.stats.count('compressed', len(compressed))
+            self.stats.add_compressor_stats(compressor.stats)
             sc = len(compressed)
             su = len(data)
             rc = sc / su
-            if self.args.verbose:
+            if self.options.verbose:
                 print("Size: {} Packed: {} Ratio: {:.2f}".format(su, sc, rc))
             log().info('Size: %d Packed: %d Ratio: %d', su, sc, rc)
 
+    def __compress_registers(self):
+        "Encode each register column as raw or delta stream, whichever packs smaller"
+        registers = self.registers
+        for channel, column in enumerate(registers.columns):
+            candidates = []
+            for transform, data in (('raw', column), ('delta', registers.delta(column))):
+                with self.stats.timer('compress'):
+                    compressor = StreamCompress(data)
+                    candidates.append((compressor.compress(), transform, compressor))
+            stream, transform, compressor = min(candidates, key=lambda candidate: len(candidate[0]))
+            registers.transforms[channel] = transform
+            registers.streams[channel] = stream
+            self.stats.count('compressed', len(registers.streams[channel]))
+            self.stats.add_compressor_stats(compressor.stats)
+            if self.options.verbose:
+                print("{}: {} Size: {} Packed: {}".format(registers.name(channel), transform,
+                                                          registers.frames, len(registers.streams[channel])))
+            log().info('%s: %s Size: %d Packed: %d', registers.name(channel), transform,
+                       registers.frames, len(registers.streams[channel]))
+
 def add_parser_args(parser):
     "Add cli arguments to parser"
     parser.add_argument('-s', '--source', type=argparse.FileType('rb'), help='path to source sap file', required=True)
     parser.add_argument('-d', '--destination', type=argparse.FileType('wb'), help='path to destination asm file', required=True)
-    parser.add_argument('-l', '--labels', nargs='+', default=['INIT', 'PLAYER'], help='labelled header keys', required=False)
-    parser.add_argument('-t', '--type', choices=('asm', 'binary'), help='select output type', default='asm')
+    parser.add_argument('-l', '--labels', nargs='+', help='labelled header keys', required=False)
+    parser.add_argument('-t', '--type', choices=('asm', 'binary'), help='select output type')
     parser.add_argument('-e', '--verbose', action='store_true', help='generate more verbose output')
     parser.add_argument('-c', '--compress', help='compress data', action='store_true')
     parser.add_argument('-u', '--uncompress', help='save routine for data uncompress', type=argparse.FileType('w'))
-    parser.add_argument('-m', '--compressor', choices=('legacy', 'lz4'), help='select compress type', default='legacy')
+    parser.add_argument('-p', '--inplace', help='place compressed data inside decode buffer', action='store_true')
+    parser.add_argument('-m', '--compressor', choices=('legacy', 'lz4', 'lz4-fast', 'hybrid', 'hybrid-lz4'), help='select compress type')
+    parser.add_argument('--stats', choices=('json',), help='print conversion statistics in given format')
+    parser.add_argument('--profile', help='profile conversion and print hottest functions', action='store_true')
+    parser.set_defaults(**SAPOptions.DEFAULTS)
 
 def get_parser():
     "Create parser and add cli arguments"
@@ -221,13 +440,26 @@ def get_parser():
     add_parser_args(parser)
     return parser
 
+def convert_sap(source, options=None, **kwargs):
+    "Convert sap music (bytes or file object) and return conversion result"
+    options = (options or SAPOptions()).replace(**kwargs)
+    sap_converter = AtariSAPConverter(options, source)
+    result = run_converter(sap_converter)
+    sap_converter.stats.finish()
+    return result
+
 def process(args):
     "Main processing"
     log().debug("Start processing")
-    sap_converter = AtariSAPConverter(args)
-    sap_converter.process()
-    sap_converter.compress()
-    sap_converter.save()
+    sap_converter = AtariSAPConverter(SAPOptions.from_args(args), args.source)
+    if args.profile:
+        result = profile(run_converter, sap_converter)
+    else:
+        result = run_converter(sap_converter)
+    result.write(args.destination, args.uncompress)
+    sap_converter.stats.finish()
+    if args.stats == 'json':
+        print(result.stats.to_json())
     log().debug("Done")
 
 def main():
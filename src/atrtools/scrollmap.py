@@ -0,0 +1,453 @@
+"""
+Large scrolling map converter.
+Cuts oversized image into row or column strips compressed independently,
+scroll routine decodes only the strip entering view into ring buffer shown by display list.
+"""
+
+import logging
+
+from atrtools.imgconv import AtariImageConverter
+from atrtools.dlist import DisplayList
+
+
+def log():
+    return logging.getLogger(__name__)
+
+
+class AtariMapConverter(AtariImageConverter):
+    "Atari scrolling map converter class"
+
+    MAX_STRIPS = 255
+    WINDOW = {'rows': 192, 'columns': 48}
+    ZERO_PAGE = (('MAP_SRC_L', '$D0', 'strip source address'),
+                 ('MAP_SRC_H', '$D1', ''),
+                 ('MAP_DST_L', '$D2', 'strip destination address'),
+                 ('MAP_DST_H', '$D3', ''))
+    DECODERS = {
+        'legacy': (('SCREEN_SRC_L', 'SCREEN_SRC_H'), ('SCREEN_DST_L', 'SCREEN_DST_H'),
+                   ('SCREEN_LEN_L', 'SCREEN_LEN_H'), 'uncompress'),
+        'lz4': (('unlz4.source', 'unlz4.source+1'), ('unlz4.dest', 'unlz4.dest+1'), None, 'unlz4'),
+        'lz4-fast': (('unlz4.source', 'unlz4.source+1'), ('unlz4.dest', 'unlz4.dest+1'), None, 'unlz4'),
+        'hybrid': (('HYBRID_TAB_L', 'HYBRID_TAB_H'), ('SCREEN_DST_L', 'SCREEN_DST_H'), None, 'unhybrid'),
+        'hybrid-lz4': (('HYBRID_TAB_L', 'HYBRID_TAB_H'), ('unlz4.dest', 'unlz4.dest+1'), None, 'unhybrid'),
+    }
+
+    def __init__(self, options, source):
+        super().__init__(options, source)
+        self.img = None
+        self.strips = []
+        self.slots = []
+        self.size = 0
+        self.buffer_size = 0
+
+    @property
+    def rows_mode(self):
+        return self.options.strip == 'rows'
+
+    @property
+    def strip_size(self):
+        return self.options.strip_size
+
+    @property
+    def window(self):
+        return self.options.window or self.__class__.WINDOW[self.options.strip]
+
+    @property
+    def columns(self):
+        return int(self.bytes_per_line)
+
+    @property
+    def count(self):
+        "Number of strips"
+        return -(-(self.height if self.rows_mode else self.columns) // self.strip_size)
+
+    @property
+    def visible(self):
+        "Number of ring buffer slots, strips partially visible at both window edges included"
+        return -(-self.window // self.strip_size) + 1
+
+    def process(self):
+        "Load image and plan ring buffer, strips are packed one by one when compressed"
+        log().debug('Processing map image')
+        with self.stats.timer('load'):
+            self.img = self.load()
+        self.width, self.height = self.img.size
+        logging.debug("Image resolution: %dx%d", self.width, self.height)
+        if self.options.verbose:
+            print("Image resolution: {}x{}".format(self.width, self.height))
+        assert self.visible <= self.count <= self.__class__.MAX_STRIPS, \
+            "Error: map needs between {} and {} strips, it has {}!".format(self.visible, self.__class__.MAX_STRIPS,
+                                                                          self.count)
+        if not self.rows_mode:
+            assert self.strip_size <= 128 and self.visible * self.strip_size < 256 and self.height < 256, \
+                "Error: column strips need strip size * slots below 256 and map height below 256!"
+        with self.stats.timer('quantize'):
+            self.quantize(self.img)
+        self.place_buffer()
+
+    def generate_strips(self):
+        "Generator for packed strips, column strips keep strip size bytes of every line"
+        ratio = self.options.ratio
+        size = self.strip_size
+        for number in range(self.count):
+            if self.rows_mode:
+                box = (0, number*size, self.width, (number+1)*size)
+            else:
+                box = (number*size*ratio, 0, (number+1)*size*ratio, self.height)
+            yield b''.join(self.pack_rows(self.img.crop(box)))
+
+    def place_buffer(self):
+        "Place ring buffer units (strip slots or doubled lines) from 4K aligned buffer start"
+        if self.rows_mode:
+            units, length = self.visible, self.strip_size * self.columns
+        else:
+            units, length = self.height, 2 * self.visible * self.strip_size
+        offset = 0
+        for _ in range(units):
+            offset = DisplayList.place(offset, length)
+            self.slots.append(offset)
+            offset += length
+        self.buffer_size = offset
+
+    def compress(self):
+        "Pack and compress map strip by strip, only packed strips are kept"
+        log().debug('Compressing map strips')
+        compressed = 0
+        for raw in self.generate_strips():
+            self.size += len(raw)
+            if self.options.compress:
+                with self.stats.timer('compress'):
+                    compressor = self.compressor_cls(raw)
+                    raw = compressor.compress()
+                self.stats.add_compressor_stats(compressor.stats)
+                compressed += len(raw)
+            self.strips.append(bytes(raw))
+        self.compressed = b''.join(self.strips)
+        self.stats.count('packed', self.size)
+        self.stats.count('compressed', compressed)
+        if self.options.verbose:
+            print("Strips: {} Size: {} Packed: {} Buffer: {}".format(self.count, self.size, len(self.compressed),
+                                                                     self.buffer_size))
+        log().info('Strips: %d Size: %d Packed: %d Buffer: %d', self.count, self.size, len(self.compressed),
+                   self.buffer_size)
+
+    def build_dlist(self):
+        "Build display list showing ring buffer, coarse scroll rewrites LMS addresses"
+        dlist = DisplayList(self.options.label)
+        dlist.blank()
+        buffer = 'buffer_{}'.format(self.options.label)
+        if self.rows_mode:
+            for line in range(self.window + 1):
+                address = '{}+${:x}'.format(buffer, self.slots[line // self.strip_size]) \
+                          if not line % self.strip_size else None
+                dlist.mode_line(self.options.antic_mode, address, vscroll=line < self.window)
+        else:
+            for line in range(self.height):
+                dlist.mode_line(self.options.antic_mode, '{}+${:x}'.format(buffer, self.slots[line]), hscroll=True)
+        dlist.check_size()
+        return dlist
+
+    def write_dlist(self):
+        "Append display list, map mode always needs it"
+        log().debug('Saving display list')
+        if self.options.align:
+            self._write("\t.align $400")
+        dlist = self.build_dlist()
+        for line in dlist.generate_lines():
+            self._write(line)
+        return dlist
+
+    def _save_asm(self):
+        "Save strips, ring buffer, display list and scroll routine as asm"
+        log().debug('Saving map data to file')
+        label = self.options.label
+        self._write("\t.local map_{} ; width={} height={} strip={} size={} strips={} {}".format(
+                    label, self.width, self.height, self.options.strip, self.strip_size, self.count,
+                    'compressed' if self.options.compress else 'raw'))
+        for number, strip in enumerate(self.strips):
+            self._write("strip{}".format(number))
+            for line in self.generate_data_lines(strip, self.options.number):
+                self._write(line)
+        self._write("\t.endl")
+
+        self._write("\t.align $1000")
+        self._write("\t.local buffer_{} ; slots={} window={}".format(label, self.visible, self.window))
+        self._write("\t\t.ds {}".format(self.buffer_size))
+        self._write("\t.endl")
+        if self.options.compress and not self.rows_mode:
+            self._write("\t.local strip_buffer_{}".format(label))
+            self._write("\t\t.ds {}".format(self.height * self.strip_size))
+            self._write("\t.endl")
+
+        dlist = self.write_dlist()
+        self.write_scroll(dlist)
+        self.write_colors()
+        self.write_uncompress()
+
+    def write_decode(self, destination):
+        "Append strip decoding into destination buffer"
+        if not self.options.compress:
+            return
+        source, dest, size, call = self.__class__.DECODERS[self.options.compressor]
+        for register, target in zip(('MAP_SRC_L', 'MAP_SRC_H'), source):
+            self._write("\t\tlda {}".format(register))
+            self._write("\t\tsta {}".format(target))
+        if destination:
+            self._write("\t\tlda #<{}".format(destination))
+            self._write("\t\tsta {}".format(dest[0]))
+            self._write("\t\tlda #>{}".format(destination))
+            self._write("\t\tsta {}".format(dest[1]))
+        else:
+            for register, target in zip(('MAP_DST_L', 'MAP_DST_H'), dest):
+                self._write("\t\tlda {}".format(register))
+                self._write("\t\tsta {}".format(target))
+        if size:
+            self._write("\t\tldx strip")
+            self._write("\t\tlda size_lo,x")
+            self._write("\t\tsta {}".format(size[0]))
+            self._write("\t\tlda size_hi,x")
+            self._write("\t\tsta {}".format(size[1]))
+        self._write("\t\tjsr {}".format(call))
+
+    def write_scroll(self, dlist):
+        "Append scroll routine decoding strips entering view"
+        log().debug('Saving scroll routine')
+        label = self.options.label
+        slots = self.visible
+        for name, value, comment in self.__class__.ZERO_PAGE:
+            self._write("{} = {}{}".format(name, value, '\t; {}'.format(comment) if comment else ''))
+        self._write_text("""
+; call init once and forward/back in vbi to scroll by one strip (carry set at map end),
+; fine scroll within strip with {register}
+\t\t.proc scroll_{label}
+init\tlda #0
+\t\tsta first
+\t\tsta head
+\t\tsta strip
+initstr\tlda strip
+\t\tsta slot
+\t\tjsr decode
+\t\tinc strip
+\t\tlda strip
+\t\tcmp #{slots}
+\t\tbne initstr
+\t\tjmp update
+
+forward\tlda first
+\t\tclc
+\t\tadc #{slots}
+\t\tcmp #{count}
+\t\tbcs atend
+\t\tsta strip
+\t\tlda head
+\t\tsta slot
+\t\tjsr decode
+\t\tinc first
+\t\tldx head
+\t\tinx
+\t\tcpx #{slots}
+\t\tbcc fwslot
+\t\tldx #0
+fwslot\tstx head
+\t\tjsr update
+\t\tclc
+atend\trts
+
+back\tlda first
+\t\tbne backok
+\t\tsec
+\t\trts
+backok\tdec first
+\t\tldx head
+\t\tbne bkslot
+\t\tldx #{slots}
+bkslot\tdex
+\t\tstx head
+\t\tstx slot
+\t\tlda first
+\t\tsta strip
+\t\tjsr decode
+\t\tjsr update
+\t\tclc
+\t\trts
+
+decode\tldx strip
+\t\tlda strip_lo,x
+\t\tsta MAP_SRC_L
+\t\tlda strip_hi,x
+\t\tsta MAP_SRC_H""".format(register='VSCROL' if self.rows_mode else 'HSCROL', label=label,
+                                  slots=slots, count=self.count))
+        if self.rows_mode:
+            self.write_rows_scroll(dlist)
+        else:
+            self.write_columns_scroll(dlist)
+
+        self._write_text("""
+first\t.byte 0
+head\t.byte 0
+strip\t.byte 0
+slot\t.byte 0""")
+        strips = ['map_{}.strip{}'.format(label, number) for number in range(self.count)]
+        self.write_table('strip_lo', ['<{}'.format(strip) for strip in strips])
+        self.write_table('strip_hi', ['>{}'.format(strip) for strip in strips])
+        self.write_table('size_lo', [len(strip) & 0xff for strip in self.strips])
+        self.write_table('size_hi', [len(strip) >> 8 for strip in self.strips])
+        self._write("\t\t.endp")
+
+    def write_rows_scroll(self, dlist):
+        "Append row strip decoding into slot and LMS update of every strip"
+        label = self.options.label
+        self._write_text("""\t\tldx slot
+\t\tlda slot_lo,x
+\t\tsta MAP_DST_L
+\t\tlda slot_hi,x
+\t\tsta MAP_DST_H""")
+        if self.options.compress:
+            self.write_decode(None)
+            self._write("\t\trts")
+        else:
+            self.write_copy(self.strip_size * self.columns)
+
+        self._write("\nupdate\tldx head")
+        for number, offset in enumerate(dlist.address_offsets()):
+            self._write_text("""\t\tlda slot_lo,x
+\t\tsta dlist_{label}+{low}
+\t\tlda slot_hi,x
+\t\tsta dlist_{label}+{high}
+\t\tinx
+\t\tcpx #{slots}
+\t\tbcc upd{number}
+\t\tldx #0
+upd{number}""".format(label=label, low=offset, high=offset+1, slots=self.visible, number=number))
+        self._write("\t\trts")
+        buffers = ['buffer_{}+${:x}'.format(label, offset) for offset in self.slots]
+        self.write_table('slot_lo', ['<({})'.format(buffer) for buffer in buffers])
+        self.write_table('slot_hi', ['>({})'.format(buffer) for buffer in buffers])
+
+    def write_copy(self, size):
+        "Append copy of constant size from strip source to destination"
+        if size >> 8:
+            self._write_text("""\t\tldy #0
+\t\tldx #{pages}
+cppage\tlda (MAP_SRC_L),y
+\t\tsta (MAP_DST_L),y
+\t\tiny
+\t\tbne cppage
+\t\tinc MAP_SRC_H
+\t\tinc MAP_DST_H
+\t\tdex
+\t\tbne cppage""".format(pages=size >> 8))
+        if size & 0xff:
+            self._write_text("""\t\tldy #{last}
+cpbyte\tlda (MAP_SRC_L),y
+\t\tsta (MAP_DST_L),y
+\t\tdey
+\t\tcpy #$ff
+\t\tbne cpbyte""".format(last=(size & 0xff) - 1))
+        self._write("\t\trts")
+
+    def write_columns_scroll(self, dlist):
+        "Append column strip decoding, strip is stored twice in every line of ring, and LMS update of every line"
+        label = self.options.label
+        if self.options.compress:
+            self.write_decode('strip_buffer_{}'.format(label))
+            self._write_text("""\t\tlda #<strip_buffer_{label}
+\t\tsta MAP_SRC_L
+\t\tlda #>strip_buffer_{label}
+\t\tsta MAP_SRC_H""".format(label=label))
+        self._write_text("""\t\tldx slot
+\t\tlda slotoff,x
+\t\tsta shift
+\t\tldx #0
+sprline\tlda line_lo,x
+\t\tclc
+\t\tadc shift
+\t\tsta MAP_DST_L
+\t\tlda line_hi,x
+\t\tadc #0
+\t\tsta MAP_DST_H
+\t\tldy #{last}
+sprcpy1\tlda (MAP_SRC_L),y
+\t\tsta (MAP_DST_L),y
+\t\tdey
+\t\tbpl sprcpy1
+\t\tlda MAP_DST_L
+\t\tclc
+\t\tadc #{ring}
+\t\tsta MAP_DST_L
+\t\tbcc sprhigh
+\t\tinc MAP_DST_H
+sprhigh\tldy #{last}
+sprcpy2\tlda (MAP_SRC_L),y
+\t\tsta (MAP_DST_L),y
+\t\tdey
+\t\tbpl sprcpy2
+\t\tlda MAP_SRC_L
+\t\tclc
+\t\tadc #{size}
+\t\tsta MAP_SRC_L
+\t\tbcc sprnext
+\t\tinc MAP_SRC_H
+sprnext\tinx
+\t\tcpx #{height}
+\t\tbne sprline
+\t\trts
+
+update\tldx head
+\t\tlda slotoff,x
+\t\tsta shift
+\t\tlda #<(dlist_{label}+{first})
+\t\tsta MAP_DST_L
+\t\tlda #>(dlist_{label}+{first})
+\t\tsta MAP_DST_H
+\t\tldx #0
+updline\tldy #0
+\t\tlda line_lo,x
+\t\tclc
+\t\tadc shift
+\t\tsta (MAP_DST_L),y
+\t\tiny
+\t\tlda line_hi,x
+\t\tadc #0
+\t\tsta (MAP_DST_L),y
+\t\tlda MAP_DST_L
+\t\tclc
+\t\tadc #3
+\t\tsta MAP_DST_L
+\t\tbcc updnext
+\t\tinc MAP_DST_H
+updnext\tinx
+\t\tcpx #{height}
+\t\tbne updline
+\t\trts
+
+shift\t.byte 0""".format(last=self.strip_size-1, ring=self.visible*self.strip_size, size=self.strip_size,
+                         height=self.height, label=label, first=dlist.address_offsets()[0]))
+        self.write_table('slotoff', [slot * self.strip_size for slot in range(self.visible)])
+        lines = ['buffer_{}+${:x}'.format(label, offset) for offset in self.slots]
+        self.write_table('line_lo', ['<({})'.format(line) for line in lines])
+        self.write_table('line_hi', ['>({})'.format(line) for line in lines])
+
+    def _save_bin(self):
+        "Save strips"
+        self.output.extend(self.strips)
+        log().debug('Saved map strips')
+
+    def packed_blocks(self):
+        "Return strips, each decoded independently"
+        return [bytes(strip) for strip in self.strips]
+
+    def result(self):
+        "Return conversion result"
+        result = super().result()
+        result.metadata.update({
+            'size': self.size,
+            'strip': self.options.strip,
+            'strip_size': self.strip_size,
+            'strips': [len(strip) for strip in self.strips],
+            'window': self.window,
+            'slots': self.visible,
+            'buffer': self.buffer_size,
+            'offsets': list(self.slots),
+        })
+        return result
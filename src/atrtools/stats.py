@@ -0,0 +1,93 @@
+"""
+Conversion statistics and profiling support.
+Collects stage timers, byte counters and compressor statistics of a single run.
+"""
+
+import io
+import sys
+import json
+import time
+import pstats
+import cProfile
+import logging
+import contextlib
+
+_HOOKS = []
+
+
+def log():
+    return logging.getLogger(__name__)
+
+
+def add_hook(hook):
+    "Register callable invoked with Stats object when conversion finishes"
+    _HOOKS.append(hook)
+
+
+def remove_hook(hook):
+    "Unregister previously added hook"
+    _HOOKS.remove(hook)
+
+
+class Stats:
+    "Statistics of a single conversion run"
+
+    def __init__(self, tool):
+        self.tool = tool
+        self.timers = {}
+        self.counters = {}
+        self.compressor = {}
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        "Measure time spent in given stage"
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timers[stage] = self.timers.get(stage, 0.0) + elapsed
+            log().debug('Stage %s: %.6fs', stage, elapsed)
+
+    def count(self, name, value):
+        "Increase named byte counter"
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_compressor_stats(self, values):
+        "Accumulate compressor statistics (runs, literals, matches)"
+        for name, value in values.items():
+            self.compressor[name] = self.compressor.get(name, 0) + value
+
+    def as_dict(self):
+        "Return statistics as dictionary"
+        return {'tool': self.tool,
+                'timers': dict(self.timers),
+                'counters': dict(self.counters),
+                'compressor': dict(self.compressor)}
+
+    def to_json(self):
+        "Return statistics as json string"
+        return json.dumps(self.as_dict(), indent=2)
+
+    def finish(self):
+        "Notify registered hooks"
+        for hook in list(_HOOKS):
+            hook(self)
+
+
+def run_converter(converter):
+    "Run all conversion stages of converter and return its result"
+    converter.process()
+    converter.compress()
+    converter.save()
+    return converter.result()
+
+
+def profile(func, *args, limit=20):
+    "Run func under cProfile and print hottest functions to stderr"
+    profiler = cProfile.Profile()
+    result = profiler.runcall(func, *args)
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats('tottime').print_stats(limit)
+    print(stream.getvalue(), file=sys.stderr)
+    return result
@@ -207,4 +207,400 @@ source          equ    *-2
                 inw    source
                 rts
 		        .endp
-"""
\ No newline at end of file
+"""
+class UncompressStream(Uncompress):
+	DEFAULTS = {
+		"STREAM_PTR_L": "$D4",
+		"STREAM_PTR_H": "$D5",
+		"POKEY": "$D200",
+		"CHANNELS_MAX": 18,
+	}
+
+	ASSEMBLY = """
+STREAM_PTR_L = {STREAM_PTR_L}	; stream pointer, apart from decoders (player runs in vbi)
+STREAM_PTR_H = {STREAM_PTR_H}
+
+POKEY = {POKEY}	; register base, stereo registers follow at +$10
+
+; ENTRY: init once to (re)start tune, play sap_registers.calls times per frame,
+;        every sap_registers.fastplay scanlines (vbi, then dli for FASTPLAY tunes)
+; DATA: sap_registers tables (channels, frames, stream starts, delta flags, registers)
+		.proc sap_player
+init	ldx #sap_registers.channels-1
+initch	lda sap_registers.start_lo,x
+		sta ptr_lo,x
+		lda sap_registers.start_hi,x
+		sta ptr_hi,x
+		lda #0
+		sta count,x
+		sta value,x
+		dex
+		bpl initch
+		lda sap_registers.frames_lo
+		sta frames_l
+		lda sap_registers.frames_hi
+		sta frames_h
+		rts
+
+play	ldx #sap_registers.channels-1
+channel	lda count,x
+		bne nextval
+		jsr fetch			; command, bit 7 set for literals
+		sta mode,x
+		and #%01111111
+		clc
+		adc #1
+		sta count,x
+		lda mode,x
+		bmi nextval
+		jsr fetch			; repeated value
+		sta repeat,x
+nextval	lda mode,x
+		bpl repval
+		jsr fetch
+		jmp apply
+repval	lda repeat,x
+apply	ldy sap_registers.delta,x
+		beq store
+		clc
+		adc value,x
+store	sta value,x
+		ldy sap_registers.reg,x
+		sta POKEY,y
+		dec count,x
+		dex
+		bpl channel
+
+		lda frames_l
+		bne decfrl
+		dec frames_h
+decfrl	dec frames_l
+		lda frames_l
+		ora frames_h
+		bne playing
+		jmp init
+playing	rts
+
+fetch	lda ptr_lo,x
+		sta STREAM_PTR_L
+		lda ptr_hi,x
+		sta STREAM_PTR_H
+		ldy #0
+		lda (STREAM_PTR_L),y
+		inc ptr_lo,x
+		bne fetched
+		inc ptr_hi,x
+fetched	rts
+
+frames_l	.byte 0
+frames_h	.byte 0
+ptr_lo	:{CHANNELS_MAX} .byte 0
+ptr_hi	:{CHANNELS_MAX} .byte 0
+count	:{CHANNELS_MAX} .byte 0
+mode	:{CHANNELS_MAX} .byte 0
+repeat	:{CHANNELS_MAX} .byte 0
+value	:{CHANNELS_MAX} .byte 0
+		.endp
+"""
+
+class UncompressLz4Fast(Uncompress):
+	DEFAULTS = {
+		"LZ4_SRC_L": "$C0",
+		"LZ4_SRC_H": "$C1",
+		"LZ4_DST_L": "$C2",
+		"LZ4_DST_H": "$C3",
+		"LZ4_PTR_L": "$C4",
+		"LZ4_PTR_H": "$C5",
+	}
+
+	ASSEMBLY = """
+LZ4_SRC_L = {LZ4_SRC_L}	; compressed source address
+LZ4_SRC_H = {LZ4_SRC_H}
+
+LZ4_DST_L = {LZ4_DST_L}	; destination address
+LZ4_DST_H = {LZ4_DST_H}
+
+LZ4_PTR_L = {LZ4_PTR_L}	; copy source address
+LZ4_PTR_H = {LZ4_PTR_H}
+
+; speed optimized unlz4, literals and matches are copied page-wise, runs (offset 1) are filled
+; ENTRY: compressed data address in source, destination address in dest
+		.proc unlz4
+source	= LZ4_SRC_L
+dest	= LZ4_DST_L
+loop	ldy #0
+		lda (LZ4_SRC_L),y
+		inc LZ4_SRC_L
+		bne token
+		inc LZ4_SRC_H
+token	sta tokval
+		lsr
+		lsr
+		lsr
+		lsr
+		beq offset			; no literals
+		jsr length
+		lda LZ4_SRC_L
+		sta LZ4_PTR_L
+		lda LZ4_SRC_H
+		sta LZ4_PTR_H
+		jsr copy
+		lda LZ4_PTR_L
+		sta LZ4_SRC_L
+		lda LZ4_PTR_H
+		sta LZ4_SRC_H
+		ldy #0
+offset	lda (LZ4_SRC_L),y
+		sta offlo
+		iny
+		lda (LZ4_SRC_L),y
+		sta offhi
+		ora offlo
+		bne match
+		rts					; offset 0 ends data
+
+match	lda LZ4_SRC_L
+		clc
+		adc #2
+		sta LZ4_SRC_L
+		bcc offread
+		inc LZ4_SRC_H
+offread	sec
+		lda LZ4_DST_L
+		sbc offlo
+		sta LZ4_PTR_L
+		lda LZ4_DST_H
+		sbc offhi
+		sta LZ4_PTR_H
+		lda tokval
+		and #$0f
+		jsr length
+		lda lenlo
+		clc
+		adc #4
+		sta lenlo
+		bcc minlen
+		inc lenhi
+minlen	lda offhi
+		bne far
+		ldx offlo
+		dex
+		bne far
+		jsr fill			; offset 1, run of previous byte
+		jmp loop
+far		jsr copy
+		jmp loop
+
+length	sta lenlo			; 15 is followed by extension bytes
+		ldy #0
+		sty lenhi
+		cmp #$0f
+		bne lendone
+lenext	lda (LZ4_SRC_L),y
+		inc LZ4_SRC_L
+		bne lenadd
+		inc LZ4_SRC_H
+lenadd	tax
+		clc
+		adc lenlo
+		sta lenlo
+		bcc lennext
+		inc lenhi
+lennext	cpx #$ff
+		beq lenext
+lendone	rts
+
+copy	ldy #0				; copy len bytes from ptr to dest, forward
+		ldx lenhi
+		beq cpyrest
+cpypage	lda (LZ4_PTR_L),y
+		sta (LZ4_DST_L),y
+		iny
+		lda (LZ4_PTR_L),y
+		sta (LZ4_DST_L),y
+		iny
+		bne cpypage
+		inc LZ4_PTR_H
+		inc LZ4_DST_H
+		dex
+		bne cpypage
+cpyrest	ldx lenlo
+		beq copied
+cpybyte	lda (LZ4_PTR_L),y
+		sta (LZ4_DST_L),y
+		iny
+		dex
+		bne cpybyte
+copied	tya
+		clc
+		adc LZ4_PTR_L
+		sta LZ4_PTR_L
+		bcc advance
+		inc LZ4_PTR_H
+		bcs advance
+
+fill	ldy #0				; fill len bytes with byte preceding dest
+		lda (LZ4_PTR_L),y
+		ldx lenhi
+		beq filrest
+filpage	sta (LZ4_DST_L),y
+		iny
+		sta (LZ4_DST_L),y
+		iny
+		bne filpage
+		inc LZ4_DST_H
+		dex
+		bne filpage
+filrest	ldx lenlo
+		beq advance
+filbyte	sta (LZ4_DST_L),y
+		iny
+		dex
+		bne filbyte
+advance	tya
+		clc
+		adc LZ4_DST_L
+		sta LZ4_DST_L
+		bcc advdone
+		inc LZ4_DST_H
+advdone	rts
+
+tokval	.byte 0
+offlo	.byte 0
+offhi	.byte 0
+lenlo	.byte 0
+lenhi	.byte 0
+		.endp
+"""
+
+class UncompressHybrid(Uncompress):
+	BACKEND = None
+	DEFAULTS = {
+		"HYBRID_TAB_L": "$C8",
+		"HYBRID_TAB_H": "$C9",
+		"HYBRID_SRC_L": "$CA",
+		"HYBRID_SRC_H": "$CB",
+		"HYBRID_DST_L": "$CC",
+		"HYBRID_DST_H": "$CD",
+		"HYBRID_LEN_L": "$CE",
+		"HYBRID_LEN_H": "$CF",
+	}
+
+	ASSEMBLY = """
+HYBRID_TAB_L = {HYBRID_TAB_L}	; packed data address
+HYBRID_TAB_H = {HYBRID_TAB_H}
+
+HYBRID_SRC_L = {HYBRID_SRC_L}	; chunk data address
+HYBRID_SRC_H = {HYBRID_SRC_H}
+
+HYBRID_DST_L = {HYBRID_DST_L}	; stored chunk destination
+HYBRID_DST_H = {HYBRID_DST_H}
+
+HYBRID_LEN_L = {HYBRID_LEN_L}	; chunk size
+HYBRID_LEN_H = {HYBRID_LEN_H}
+
+; ENTRY: packed data address in HYBRID_TAB, destination address in {DEST_L}
+		.proc unhybrid
+		lda HYBRID_TAB_L
+		sta HYBRID_SRC_L
+		lda HYBRID_TAB_H
+		sta HYBRID_SRC_H
+chunk	ldy #0				; size word precedes chunk data, zero word ends data
+		lda (HYBRID_SRC_L),y
+		sta HYBRID_LEN_L
+		iny
+		lda (HYBRID_SRC_L),y
+		sta HYBRID_LEN_H
+		ora HYBRID_LEN_L
+		bne nextent
+		rts
+nextent	lda HYBRID_SRC_L
+		clc
+		adc #2
+		sta HYBRID_SRC_L
+		bcc entry
+		inc HYBRID_SRC_H
+entry	lda HYBRID_LEN_H
+		bmi stored
+{DECODE}
+		lda HYBRID_SRC_L		; skip decoded chunk
+		clc
+		adc HYBRID_LEN_L
+		sta HYBRID_SRC_L
+		lda HYBRID_SRC_H
+		adc HYBRID_LEN_H
+		sta HYBRID_SRC_H
+		jmp chunk
+
+stored	and #%01111111		; copy whole pages, then rest
+		tax
+		lda {DEST_L}
+		sta HYBRID_DST_L
+		lda {DEST_H}
+		sta HYBRID_DST_H
+		ldy #0
+		txa
+		beq part
+page	lda (HYBRID_SRC_L),y
+		sta (HYBRID_DST_L),y
+		iny
+		bne page
+		inc HYBRID_SRC_H
+		inc HYBRID_DST_H
+		dex
+		bne page
+part	ldx HYBRID_LEN_L
+		beq copied
+rest	lda (HYBRID_SRC_L),y
+		sta (HYBRID_DST_L),y
+		iny
+		dex
+		bne rest
+copied	tya
+		clc
+		adc HYBRID_SRC_L
+		sta HYBRID_SRC_L
+		bcc srcdone
+		inc HYBRID_SRC_H
+srcdone	tya
+		clc
+		adc HYBRID_DST_L
+		sta {DEST_L}
+		lda HYBRID_DST_H
+		adc #0
+		sta {DEST_H}
+		jmp chunk
+		.endp
+"""
+
+	@property
+	def assembly(self):
+		return self.__class__.BACKEND().assembly + super().assembly
+
+
+class UncompressHybridLegacy(UncompressHybrid):
+	BACKEND = UncompressLegacy
+	DEFAULTS = dict(UncompressHybrid.DEFAULTS,
+		DEST_L="SCREEN_DST_L",
+		DEST_H="SCREEN_DST_H",
+		DECODE="""		lda HYBRID_SRC_L
+		sta SCREEN_SRC_L
+		lda HYBRID_SRC_H
+		sta SCREEN_SRC_H
+		lda HYBRID_LEN_L
+		sta SCREEN_LEN_L
+		lda HYBRID_LEN_H
+		sta SCREEN_LEN_H
+		jsr uncompress""")
+
+
+class UncompressHybridLz4(UncompressHybrid):
+	BACKEND = UncompressLz4
+	DEFAULTS = dict(UncompressHybrid.DEFAULTS,
+		DEST_L="unlz4.dest",
+		DEST_H="unlz4.dest+1",
+		DECODE="""		lda HYBRID_SRC_L
+		sta unlz4.source
+		lda HYBRID_SRC_H
+		sta unlz4.source+1
+		jsr unlz4""")
@@ -11,6 +11,8 @@ setup(
     install_requires = ['pillow', 'lz4'],
     entry_points = {'console_scripts': ['atrtools=atrtools.__main__:main', 
                                         'imgconv=atrtools.imgconv:main',
-                                        'sapconv=atrtools.sapconv:main'] },
+                                        'sapconv=atrtools.sapconv:main',
+                                        'atrbanks=atrtools.banks:main',
+                                        'atrbatch=atrtools.pipeline:main'] },
     zip_safe=True
 )
\ No newline at end of file